@@ -1,3 +1,7 @@
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
 from typing import Annotated
 from pathlib import Path
 from fastapi import (
@@ -5,27 +9,52 @@ from fastapi import (
     FastAPI,
     File,
     Form,
+    Request,
     UploadFile,
     HTTPException,
 )
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from postgrest.types import CountMethod
+from redis.asyncio import Redis as AsyncRedis
 from supabase import (
+    AsyncClient,
     AuthApiError,
-    Client,
+    acreate_client,
 )
+from config import config
 from services import autoscout24, lacentrale, leboncoin
-from utilities import utils
-from supabase import (
-    create_client,
+from utilities import (
+    db,
+    limits,
+    listing,
+    metrics,
+    progress,
+    responses,
+    runstate,
+    sheet,
+    utils,
 )
-from supabase.lib.client_options import SyncClientOptions
+from utilities.cache import bump_version, get_version
+from utilities.limits import limited
+from utilities.responses import STATUS_VERSION, response_cache
+from supabase.lib.client_options import AsyncClientOptions
 from celery_app import celery_app, start_services_task
 from pydantic import BaseModel
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await db.init_async_pool()
+    if config.API_PRELOAD:
+        await preload()
+    yield
+    await db.close_async_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -43,42 +72,24 @@ domain_functions = {
 }
 
 
-def get_session() -> Client:
-    client: Client = create_client(
+async def get_session() -> AsyncClient:
+    # Login stores the user session on the client, so it never uses the pool
+    client: AsyncClient = await acreate_client(
         supabase_key=utils.supabase_key,
         supabase_url=utils.url,
-        options=SyncClientOptions(postgrest_client_timeout=60000),
+        options=AsyncClientOptions(postgrest_client_timeout=60000),
     )
     return client
 
 
-
-def get_avg_price_based_on_domain(
-    records: list[dict],
-    percentage_limit: int = 95,
-):
-    # Get the average price based on the best matching percentage for each domain
-    best_prices = []
-    for domain in domains:
-        for record in records:
-            if (record["domain"] == domain) and (
-                record["matching_percentage"] >= percentage_limit
-            ):
-                best_prices.append(record["price"])
-    best_prices = [bp for bp in best_prices if bp]
-    if best_prices:
-        return sum(best_prices) / len(best_prices)
-    else:
-        return 0
-
 @app.post("/login")
-def login(
-    client: Annotated[Client, Depends(get_session)],
+async def login(
+    client: Annotated[AsyncClient, Depends(get_session)],
     email: str,
     password: str,
 ):
     try:
-        response = client.auth.sign_in_with_password(
+        response = await client.auth.sign_in_with_password(
             credentials={
                 "email": email,
                 "password": password,
@@ -95,83 +106,256 @@ def login(
         )
 
 
-@app.get("/get_all_cars")
-def get_all_cars(
+def get_select(fields: list[str] | None, comparison_fields: str | None) -> str:
+    # Columns of Vehicles for the requested fields and the aggregates
+    comparisons = f"comparisons({comparison_fields or '*'})"
+    if fields is None:
+        return f"*, {comparisons}"
+    columns = ["id", "price_with_tax"] + [
+        listing.stats_column(site) for site in listing.stats_sites
+    ]
+    columns += [
+        field
+        for field in fields
+        if (field not in columns)
+        and (field not in listing.computed_fields)
+        and (field != "comparisons")
+    ]
+    if "comparisons" in fields:
+        columns.append(comparisons)
+    return ", ".join(columns)
+
+
+async def get_vehicles_page(
+    client: AsyncClient,
+    limit: int,
+    cursor: int | None,
+    domain: str | None,
+    select: str = "*, comparisons(*)",
+    offset: int = 0,
+    ids: list | None = None,
+    names: dict[str, str] | None = None,
+):
+    # Base query
+    stmt = filter_names(client.table("Vehicles").select(select), names).order("id")
+    if "comparisons(" in select:
+        stmt = stmt.order(
+            "matching_percentage",
+            desc=True,
+            foreign_table="comparisons",
+        )
+        # Apply domain filter if provided
+        if domain:
+            stmt = stmt.eq("comparisons.domain", domain)
+
+    if ids is not None:
+        # Page already selected on the vehicle index
+        return await stmt.in_("id", ids).execute()
+
+    # Apply cursor if provided (for subsequent pages)
+    if cursor is not None:
+        stmt = stmt.gt("id", cursor)
+    return await stmt.range(offset, offset + limit - 1).execute()
+
+
+def filter_names(stmt, names: dict[str, str] | None):
+    # make and model filters, matched like the sheet values whatever their case
+    for column, value in (names or {}).items():
+        if value:
+            stmt = stmt.ilike(column, listing.name_pattern(value))
+    return stmt
+
+
+async def load_rows(select: str, names: dict[str, str] | None = None) -> list[dict]:
+    rows = []
+    cursor = None
+    async with db.asession() as client:
+        while True:
+            stmt = (
+                filter_names(client.table("Vehicles").select(select), names)
+                .order("id")
+                .limit(1000)
+            )
+            if cursor is not None:
+                stmt = stmt.gt("id", cursor)
+            data = (await stmt.execute()).data
+            rows += data
+            if len(data) < 1000:
+                return rows
+            cursor = data[-1]["id"]
+
+
+async def load_index_rows() -> list[dict]:
+    return await load_rows(", ".join(listing.index_columns()))
+
+
+async def count_vehicles(names: dict[str, str] | None = None) -> int:
+    # The domain filter only applies to the embedded comparisons, so every
+    # page query counts all the vehicles and the join is not needed
+    async with db.asession() as client:
+        response = await (
+            filter_names(
+                client.table("Vehicles").select("id", count=CountMethod.exact),
+                names,
+            )
+            .limit(1)
+            .execute()
+        )
+    return response.count
+
+
+async def preload():
+    # The count is shared through the cache, only the first worker queries it
+    start = time.perf_counter()
+    try:
+        await listing.cached_count(count_vehicles)
+        print(f"Preloaded in {time.perf_counter() - start:.1f}s")
+    except Exception as e:
+        print(f"Preload error - {e}")
+
+
+@app.get("/cars/count")
+async def get_cars_count(fresh: bool = False):
+    return await limited("cars_count", read_cars_count(fresh))
+
+
+async def read_cars_count(fresh: bool):
+    try:
+        return {
+            "total": await listing.cached_count(count_vehicles, fresh),
+            "version": await asyncio.to_thread(get_version, listing.VERSION),
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def list_cars(
     limit: int = 20,
     cursor: int | None = None,  # Changed from offset to cursor
     cut_off_price: int = 500,
     domain: str | None = None,
     percentage_limit: int = 95,
+    include_total: bool = True,
+    offset: int = 0,
+    fields: str | None = None,
+    comparison_fields: str | None = None,
+    card_color: str | None = None,
+    min_best_match: float | None = None,
+    sort: str = "id",
+    make: str | None = None,
+    model: str | None = None,
 ):
-    client = get_session()
+    if sort not in listing.sort_keys:
+        raise HTTPException(
+            status_code=400,
+            detail=f"sort must be one of {list(listing.sort_keys)}",
+        )
+    if card_color not in [None, "green", "yellow", "red"]:
+        raise HTTPException(
+            status_code=400,
+            detail="card_color must be green, yellow or red",
+        )
+    if (cursor is not None) and offset:
+        # Both would skip rows, the offset counting from the cursor
+        raise HTTPException(
+            status_code=400,
+            detail="Use either cursor or offset, not both",
+        )
+    if (cursor is not None) and (sort != "id"):
+        # The cursor is an id, pages of other sorts go by offset
+        raise HTTPException(
+            status_code=400,
+            detail="cursor only works with sort=id, use offset",
+        )
+    names = {"make": make, "model": model} if (make or model) else None
+    sites = [listing.site_of(domain)] if domain else None
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    select = get_select(field_list, comparison_fields)
     try:
-        # Base query
-        stmt = (
-            client.table("Vehicles")
-            .select("*, comparisons(*)", count=CountMethod.exact)
-            .limit(limit)
-            .order("id")  # Primary sort by ID for cursor
-            .order(
-                "matching_percentage",
-                desc=True,
-                foreign_table="comparisons",
+        # Filters and sorts on computed fields run on the vehicle index, only
+        # the page is fetched. make and model are filtered by PostgREST
+        entries = None
+        if card_color or (min_best_match is not None) or (sort != "id"):
+            entries = await listing.vehicle_index.query(
+                load_index_rows,
+                sites,
+                percentage_limit,
+                cut_off_price,
+                card_color,
+                min_best_match,
+                sort,
             )
-        )
-
-        # Apply cursor if provided (for subsequent pages)
-        if cursor is not None:
-            stmt = stmt.gt("id", cursor)
-
-        # Apply domain filter if provided
-        if domain:
-            stmt = stmt.eq("comparisons.domain", domain)
+            if names:
+                ids = {row["id"] for row in await load_rows("id", names)}
+                entries = [entry for entry in entries if entry["id"] in ids]
+            if cursor is not None:
+                entries = [entry for entry in entries if entry["id"] > cursor]
+            total = len(entries) if include_total else None
+            entries = entries[offset : offset + limit]
+
+        async with db.asession() as client:
+            if entries is not None:
+                ids = [entry["id"] for entry in entries]
+                response = await get_vehicles_page(
+                    client, limit, None, domain, select, ids=ids
+                )
+            else:
+                response = await get_vehicles_page(
+                    client, limit, cursor, domain, select, offset, names=names
+                )
 
-        response = stmt.execute()
         vehicles = []
         next_cursor = None
-
-        for vehicle in response.data:
-            comparison_prices = [x["price"] for x in vehicle["comparisons"]]
-            comparison_prices = [0] if not comparison_prices else comparison_prices
-            vehicle["lowest_price"] = min(comparison_prices)
-            vehicle["average_price"] = sum(comparison_prices) / len(comparison_prices)
-            avg_price = get_avg_price_based_on_domain(
-                vehicle["comparisons"],
-                percentage_limit,
-            )
-            vehicle["average_price_based_on_best_match"] = avg_price
-            vehicle["price_difference_with_avg_price"] = (
-                avg_price - vehicle["price_with_tax"]
-            )
-            if vehicle["price_with_tax"] < avg_price:
-                vehicle["card_color"] = "green"
-            elif abs(vehicle["price_with_tax"] - avg_price) >= cut_off_price:
-                vehicle["card_color"] = "red"
-            else:
-                vehicle["card_color"] = "yellow"
-            best_match_cars = sorted(
-                vehicle["comparisons"],
-                key=lambda x: x["matching_percentage"],
-                reverse=True,
-            )
-            vehicle["best_match_percentage"] = 0
-            vehicle["best_match_link"] = None
-            if best_match_cars:
-                best_match_car = best_match_cars[0]
-                vehicle["best_match_percentage"] = best_match_car.get(
-                    "matching_percentage"
+        if entries is not None:
+            rows = {row["id"]: row for row in response.data}
+            vehicles = [
+                {**rows[entry["id"]], **entry}
+                for entry in entries
+                if entry["id"] in rows
+            ]
+        else:
+            # Served from the cached counter, pages can also skip it entirely,
+            # a count filtered on make or model is asked to PostgREST
+            total = None
+            if include_total and names:
+                total = await count_vehicles(names)
+            elif include_total:
+                total = await listing.cached_count(count_vehicles)
+            for vehicle in response.data:
+                # Precomputed summaries, the comparisons for rows written before
+                matches = listing.vehicle_matches(vehicle, sites)
+                if matches is None:
+                    matches = listing.to_matches(vehicle.get("comparisons", []))
+                vehicle.update(
+                    listing.compute(
+                        vehicle["price_with_tax"],
+                        matches,
+                        percentage_limit,
+                        cut_off_price,
+                    )
                 )
-                vehicle["best_match_link"] = best_match_car.get("link")
-            vehicles.append(vehicle)
+                vehicles.append(vehicle)
+
+        for idx, vehicle in enumerate(vehicles):
+            if field_list:
+                vehicles[idx] = {
+                    key: value
+                    for key, value in vehicle.items()
+                    if (key == "id") or (key in field_list)
+                }
+            else:
+                for site in listing.stats_sites:
+                    vehicle.pop(listing.stats_column(site), None)
 
-        # Set next cursor to the last vehicle's ID
-        if vehicles:
+        # Set next cursor to the last vehicle's ID, only id pages follow it
+        if vehicles and (sort == "id"):
             next_cursor = vehicles[-1]["id"]
 
         return {
             "details": jsonable_encoder(vehicles),
-            "total": response.count,
+            "total": total,
             "next_cursor": next_cursor,  # Return cursor for next page
+            "next_offset": offset + len(vehicles),
             "has_more": len(vehicles) == limit,  # Indicate if more pages exist
         }
     except AuthApiError:
@@ -183,11 +367,52 @@ def get_all_cars(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/get_all_cars")
+async def get_all_cars(
+    request: Request,
+    limit: int = 20,
+    cursor: int | None = None,  # Changed from offset to cursor
+    cut_off_price: int = 500,
+    domain: str | None = None,
+    percentage_limit: int = 95,
+    include_total: bool = True,
+    offset: int = 0,
+    fields: str | None = None,
+    comparison_fields: str | None = None,
+    card_color: str | None = None,
+    min_best_match: float | None = None,
+    sort: str = "id",
+    make: str | None = None,
+    model: str | None = None,
+):
+    # Parsed parameters so equivalent query strings share an entry
+    params = {key: value for key, value in locals().items() if key != "request"}
+    return await limited(
+        "get_all_cars",
+        response_cache.respond(
+            request,
+            "get_all_cars",
+            params,
+            [listing.VERSION],
+            lambda: list_cars(**params),
+        ),
+    )
+
+
 @app.get("/scrape_status")
-def get_status():
+async def get_status(request: Request):
+    return await limited(
+        "scrape_status",
+        response_cache.respond(
+            request, "scrape_status", {}, [STATUS_VERSION], read_status
+        ),
+    )
+
+
+async def read_status():
     try:
-        client = get_session()
-        response = client.table("Status").select("*").execute()
+        async with db.asession() as client:
+            response = await client.table("Status").select("*").execute()
         return {
             # "session": jsonable_encoder(auth),
             "details": jsonable_encoder(response),
@@ -201,8 +426,94 @@ def get_status():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def progress_run(run_id: str | None) -> str:
+    if run_id:
+        return run_id
+    last = runstate.get_last()
+    if not last:
+        raise HTTPException(status_code=404, detail="No run found")
+    return last["run_id"]
+
+
+@app.get("/progress")
+def get_progress(run_id: str | None = None):
+    run_id = progress_run(run_id)
+    return {"run_id": run_id, **progress.snapshot(run_id)}
+
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def progress_events(run_id: str, request: Request):
+    """
+    Current snapshot, then every event the workers publish for the run until
+    it finishes, with keep-alive comments so proxies keep the stream open.
+    """
+    redis = AsyncRedis.from_url(config.CACHE_REDIS_URL, decode_responses=True)
+    pubsub = redis.pubsub()
+    try:
+        # Subscribe before the snapshot so no event falls in between
+        await pubsub.subscribe(progress.channel(run_id))
+        data = await run_in_threadpool(progress.snapshot, run_id)
+        yield sse("snapshot", {"run_id": run_id, **data})
+        if data["status"] in ("success", "failed", "stopped"):
+            return
+        last_sent = time.monotonic()
+        while not await request.is_disconnected():
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=1.0
+            )
+            if message:
+                data = json.loads(message["data"])
+                yield sse(data["event"], data)
+                last_sent = time.monotonic()
+                if data["event"] == "finished":
+                    return
+            elif time.monotonic() - last_sent >= config.PROGRESS_KEEPALIVE:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+        await redis.aclose()
+
+
+@app.get("/progress/stream")
+async def stream_progress(request: Request, run_id: str | None = None):
+    run_id = await run_in_threadpool(progress_run, run_id)
+    return StreamingResponse(
+        progress_events(run_id, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+
+@app.get("/health")
+async def get_health():
+    return await limited("health", check_health())
 
 
+async def check_health():
+    pool = await db.get_async_pool()
+    async with pool.session() as client:
+        healthy = await pool.health_check(client)
+    return {
+        "supabase": "ok" if healthy else "unreachable",
+        "pool": pool.stats(),
+    }
+
+
+@app.get("/cache-stats")
+def get_cache_stats():
+    return {
+        "filter_cache": metrics.hit_ratio("filter_cache"),
+        "cascade": metrics.get("cascade"),
+        "writes": metrics.get("writes"),
+        "responses": responses.stats(),
+        "limits": limits.stats(),
+    }
 
 
 UPLOAD_DIR = Path("uploads")
@@ -245,9 +556,20 @@ async def upload_file(
 
     file_path = UPLOAD_DIR / filename
 
-    # 4. Sauvegarde locale
+    # 4. Un fichier identique au précédent n'est pas converti à nouveau
+    source_hash = sheet.content_hash(content)
+    if (upload_type == "Input File") and sheet.is_current(file_path, source_hash):
+        return {
+            "message": "File unchanged",
+            "filename": filename,
+            "path": str(file_path),
+            "upload_type": upload_type,
+        }
+
+    # 5. Sauvegarde locale, le fichier Excel est validé avant de remplacer l'ancien
+    tmp_path = UPLOAD_DIR / f"tmp-{filename}"
     try:
-        with open(file_path, "wb") as f:
+        with open(tmp_path, "wb") as f:
             f.write(content)
     except Exception as e:
         raise HTTPException(
@@ -255,6 +577,20 @@ async def upload_file(
             detail=f"Failed to save file locally: {e}",
         )
 
+    if upload_type == "Input File":
+        try:
+            records = await run_in_threadpool(sheet.normalize, tmp_path)
+        except Exception as e:
+            tmp_path.unlink(missing_ok=True)
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid Excel file: {e}",
+            )
+        tmp_path.replace(file_path)
+        await run_in_threadpool(sheet.write_cache, file_path, records, source_hash)
+    else:
+        tmp_path.replace(file_path)
+
     return {
         "message": "File uploaded successfully",
         "filename": filename,
@@ -269,39 +605,48 @@ class StartTaskRequest(BaseModel):
     sites_to_scrape: list[str]
     dev: bool | None = None
     car_id: int | str | None = None
+    # Continue the last run, with its own parameters, where it stopped
+    resume: bool = False
 
 
 @app.post("/start-task")
-def start_task(request: StartTaskRequest):
+async def start_task(request: StartTaskRequest):
     """
     Start the scraping task in the background using Celery.
     Returns a task_id for future usage.
     """
+    return await limited("start_task", dispatch_task(request))
+
+
+async def dispatch_task(request: StartTaskRequest):
     try:
         # Update Status table to indicate task is starting
-        client = get_session()
-        client.table("Status").update(
-            {
-                "id": 1,
-                "status": "starting",
-                "stopped_at": None,
-                "total_completed": 0,
-                "total_running": 0,
-            }
-        ).eq("id", 1).execute()
+        async with db.asession() as client:
+            await client.table("Status").update(
+                {
+                    "id": 1,
+                    "status": "starting",
+                    "stopped_at": None,
+                    "total_completed": 0,
+                    "total_running": 0,
+                }
+            ).eq("id", 1).execute()
+        await asyncio.to_thread(bump_version, STATUS_VERSION)
 
         # Use default values if None is provided
         mileage = request.mileage_plus_minus if request.mileage_plus_minus is not None else 10000
         ignore_old = request.ignore_old if request.ignore_old is not None else False
         dev = request.dev if request.dev is not None else True
 
-        # Start the Celery task
-        task = start_services_task.delay(
+        # Start the Celery task, publishing to the broker blocks
+        task = await run_in_threadpool(
+            start_services_task.delay,
             mileage_plus_minus=mileage,
             ignore_old=ignore_old,
             sites_to_scrape=request.sites_to_scrape,
             dev=dev,
             car_id=request.car_id,
+            resume=request.resume,
         )
 
         return {
@@ -314,26 +659,39 @@ def start_task(request: StartTaskRequest):
         raise HTTPException(status_code=500, detail=f"Failed to start task: {str(e)}")
 
 
+def signal_stop(task_id: str):
+    # Revoke the task with terminate=True for immediate stop, the jobs it
+    # already dispatched skip their work once the run is flagged
+    celery_app.control.revoke(task_id, terminate=True, signal="SIGTERM")
+    run_id = runstate.run_for_task(task_id)
+    runstate.stop(run_id)
+    progress.finish(run_id, "stopped")
+
+
 @app.post("/stop-task/{task_id}")
-def stop_task(task_id: str):
+async def stop_task(task_id: str):
     """
     Stop a running Celery task by its task_id.
     """
+    return await limited("stop_task", cancel_task(task_id))
+
+
+async def cancel_task(task_id: str):
     try:
-        # Revoke the task with terminate=True for immediate stop
-        celery_app.control.revoke(task_id, terminate=True, signal="SIGTERM")
+        await run_in_threadpool(signal_stop, task_id)
 
         # Update Status table to indicate task was stopped
-        client = get_session()
         from datetime import datetime
 
-        client.table("Status").update(
-            {
-                "id": 1,
-                "status": "stopped",
-                "stopped_at": datetime.now().isoformat(),
-            }
-        ).eq("id", 1).execute()
+        async with db.asession() as client:
+            await client.table("Status").update(
+                {
+                    "id": 1,
+                    "status": "stopped",
+                    "stopped_at": datetime.now().isoformat(),
+                }
+            ).eq("id", 1).execute()
+        await asyncio.to_thread(bump_version, STATUS_VERSION)
 
         return {
             "message": "Task stop signal sent",
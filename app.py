@@ -1,24 +1,25 @@
-from concurrent.futures import ThreadPoolExecutor
+import random
+from collections import Counter
+from concurrent.futures import Future
 from copy import deepcopy
 from datetime import datetime
 from pathlib import Path
 from typing import Optional, Union
+from uuid import uuid4
 
-import pandas as pd
 from fastapi import (
     FastAPI,
     HTTPException,
 )
 from fastapi.middleware.cors import CORSMiddleware
-from supabase import (
-    Client,
-    create_client,
-)
-from supabase.lib.client_options import SyncClientOptions
 
 from config import config
 from services import autoscout24, lacentrale, leboncoin
-from utilities import utils
+from utilities import db, progress, runstate, sheet, utils
+from utilities.cache import bump_version
+from utilities.responses import STATUS_VERSION
+from utilities.scheduler import SiteScheduler, pop_completed_rows
+from utilities.writer import write_buffer
 
 OUT_FILE = Path(config.UPLOAD_FILE)
 domains = [lacentrale.domain, autoscout24.domain, leboncoin.domain]
@@ -48,36 +49,195 @@ def get_avg_price_based_on_domain(
         return 0
 
 
-def get_session() -> Client:
-    client: Client = create_client(
-        supabase_key=utils.supabase_key,
-        supabase_url=utils.url,
-        options=SyncClientOptions(postgrest_client_timeout=60000),
-    )
-    return client
+def get_scraped_sites(row_ids: list) -> dict[str, set[str]]:
+    # Fetch the scraped flags of every row in a few chunked `in` queries
+    # Sent normalized, 123.0 read from the sheet would match nothing
+    row_ids = list(dict.fromkeys([utils.id_key(row_id) for row_id in row_ids]))
+    scraped_sites = {}
+    chunk_size = config.IGNORE_OLD_CHUNK_SIZE
+    with db.session() as client:
+        for idx in range(0, len(row_ids), chunk_size):
+            response = (
+                client.table("Vehicles")
+                .select("id", "leboncoin", "lacentrale")
+                .in_("id", row_ids[idx : idx + chunk_size])
+                .execute()
+            )
+            for record in response.data:
+                scraped_sites[utils.id_key(record["id"])] = {
+                    site for site in ["leboncoin", "lacentrale"] if record.get(site)
+                }
+    print(f"Already scraped - {len(scraped_sites)} of {len(row_ids)} ids")
+    return scraped_sites
 
 
 def check_if_id_supabase(
-    row_id: str, ignore_old: bool, site_to_scrape: list[str]
+    row_id: str,
+    ignore_old: bool,
+    site_to_scrape: list[str],
+    scraped_sites: dict[str, set[str]] | None = None,
 ) -> list[str]:
     site_to_scrape = deepcopy(site_to_scrape)
     if not ignore_old:
         return site_to_scrape
-    client = get_session()
-    response = (
-        client.table("Vehicles")
-        .select("id", "leboncoin", "lacentrale")
-        .eq("id", row_id)
-        .execute()
+    if scraped_sites is None:
+        scraped_sites = get_scraped_sites([row_id])
+    done_sites = scraped_sites.get(utils.id_key(row_id), set())
+    return [site for site in site_to_scrape if site not in done_sites]
+
+
+def set_status(status: dict):
+    with db.session() as client:
+        client.table("Status").update({"id": 1, **status}).eq("id", 1).execute()
+    # Drops the cached /scrape_status responses
+    bump_version(STATUS_VERSION)
+
+
+def update_status(completed: int, total: int, run_id: str | None = None):
+    # A job finishing after /stop-task must not write "running" back
+    if run_id and runstate.is_stopped(run_id):
+        return
+    # Coalesced to one write per STATUS_WRITE_INTERVAL for the jobs of a run
+    if run_id and (not progress.status_due(run_id)):
+        return
+    set_status(
+        {
+            "status": "running",
+            "stopped_at": None,
+            "total_completed": completed,
+            "total_running": total,
+        }
+    )
+
+
+def get_car_dicts(
+    dev: bool = True,
+    car_id: Optional[Union[str, int]] = None,
+    row_ids: list | None = None,
+):
+    # Normalized records of the upload, a single vehicle is read by offset
+    if car_id:
+        car_dict = sheet.load_record(OUT_FILE, car_id)
+        print(f"Car {car_id} found - {bool(car_dict)}")
+        return [car_dict] if car_dict else []
+    car_dicts = sheet.load_records(OUT_FILE)
+    if row_ids is not None:
+        # Rows of a resumed run
+        keys = {utils.id_key(row_id) for row_id in row_ids}
+        car_dicts = [d for d in car_dicts if utils.id_key(d["id"]) in keys]
+    elif dev:
+        car_dicts = random.sample(car_dicts, min(1000, len(car_dicts)))
+    print(f"Total: {len(car_dicts)}")
+    return car_dicts
+
+
+def plan_jobs(
+    ignore_old: bool,
+    sites_to_scrape: list[str],
+    dev: bool = True,
+    car_id: Optional[Union[str, int]] = None,
+    run_id: str | None = None,
+) -> tuple[int, list[tuple[dict, list[str]]]]:
+    """
+    Number of rows of the run and, for every row not complete yet, its car
+    dict with the sites to scrape. With a run id the (row, site) jobs the run
+    already did are left out.
+    """
+    row_ids = runstate.get_rows(run_id) if run_id else None
+    car_dicts = get_car_dicts(dev, car_id, row_ids)
+    done = set()
+    if run_id:
+        if row_ids is None:
+            runstate.set_rows(run_id, [d["id"] for d in car_dicts])
+        done = runstate.done_jobs(run_id)
+    scraped_sites = {}
+    if ignore_old:
+        scraped_sites = get_scraped_sites([d["id"] for d in car_dicts])
+    jobs = []
+    for car_dict in car_dicts:
+        print(f"Car Info - {car_dict}")
+        updated_sites_to_scrape = check_if_id_supabase(
+            car_dict["id"],
+            ignore_old=ignore_old,
+            site_to_scrape=sites_to_scrape,
+            scraped_sites=scraped_sites,
+        )
+        print(f"ID is not scraped by - {updated_sites_to_scrape}")
+        if sites_to_scrape and (not updated_sites_to_scrape):
+            # Already complete, nothing to schedule
+            continue
+
+        # Verifying which to scrape from
+        if not sites_to_scrape:
+            row_sites = list(domain_functions)
+        else:
+            row_sites = [
+                site for site in updated_sites_to_scrape if site in domain_functions
+            ]
+        row_sites = [
+            site
+            for site in row_sites
+            if runstate.job_key(car_dict["id"], site) not in done
+        ]
+        if row_sites:
+            jobs.append((car_dict, row_sites))
+    return len(car_dicts), jobs
+
+
+def start_progress(run_id: str, jobs: list[tuple[dict, list[str]]]) -> int:
+    # Jobs of every site, those a resumed run already did included
+    done = runstate.done_jobs(run_id)
+    site_done = Counter([key.rsplit(":", 1)[1] for key in done])
+    site_totals = Counter([site for _, row_sites in jobs for site in row_sites])
+    site_totals.update(site_done)
+    progress.start(run_id, dict(site_totals), dict(site_done))
+    total = sum(site_totals.values())
+    update_status(sum(site_done.values()), total)
+    return total
+
+
+def run_job(
+    run_id: str,
+    site: str,
+    car_dict: dict,
+    mileage_plus_minus: int,
+    flush: bool = False,
+    generation: int | None = None,
+) -> str:
+    # Queued by a dispatch the run was resumed over, the new one does the job
+    if not runstate.is_current(run_id, generation):
+        return "stale"
+    if runstate.is_stopped(run_id):
+        return "stopped"
+    # The service mains are runners, they log their errors and return False
+    if domain_functions[site](car_dict, mileage_plus_minus):
+        status = "completed"
+        # Checkpointed once the rows of the job are in the database
+        row_id = car_dict["id"]
+        write_buffer.defer(lambda: runstate.mark_done(run_id, row_id, site))
+    else:
+        print(f"Error - {site} - {car_dict['id']}")
+        status = "failed"
+    # A job that only counts once its rows are written, e.g. an acked task
+    if flush and (not write_buffer.flush()):
+        status = "failed"
+    snapshot = progress.record(run_id, site, status)
+    if not runstate.is_stopped(run_id):
+        update_status(snapshot["finished"], snapshot["total"], run_id)
+    return status
+
+
+def finish_run(run_id: str, status: str):
+    progress.finish(run_id, status)
+    snapshot = progress.snapshot(run_id)
+    set_status(
+        {
+            "status": status,
+            "stopped_at": datetime.now().isoformat(),
+            "total_completed": snapshot.get("finished", 0),
+            "total_running": snapshot.get("total", 0),
+        }
     )
-    if not response.data:
-        return site_to_scrape
-    record = response.data[0]
-    if record.get("leboncoin"):
-        site_to_scrape.remove("leboncoin") if "leboncoin" in site_to_scrape else None
-    if record.get("lacentrale"):
-        site_to_scrape.remove("lacentrale") if "lacentrale" in site_to_scrape else None
-    return site_to_scrape
 
 
 @utils.runner
@@ -87,76 +247,76 @@ def start_services(
     sites_to_scrape: list[str],
     dev: bool = True,
     car_id: Optional[Union[str, int]] = None,
+    resume: bool = False,
+    run_id: str | None = None,
 ):
-    client = get_session()
     try:
-        if dev:
-            df = pd.read_excel(OUT_FILE, header=None).sample(1000)
-        else:
-            df = pd.read_excel(OUT_FILE, header=None)
-            print(f"Total: {len(df)}")
-
-        new_columns = []
-        for col in df.columns.to_list():
-            new_columns.append(utils.numeric_to_alphabetic_column_name(int(col)))
-        df.columns = new_columns
-        df.fillna(value=0, inplace=True)
-        for row_id in range(len(df)):
-            car_dict = utils.get_row_dict(df, row_id)
-            if (car_id) and (car_dict["id"] != car_id):
-                continue
-
-            print(f"Car Info - {car_dict}")
-            updated_sites_to_scrape = check_if_id_supabase(
-                car_dict["id"], ignore_old=ignore_old, site_to_scrape=sites_to_scrape
-            )
-            print(f"ID is not scraped by - {updated_sites_to_scrape}")
-
-            # Verifying which to scrape from and submitting the tasks to the thread pool
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                if not sites_to_scrape:
-                    for func in domain_functions:
-                        executor.submit(
-                            domain_functions[func],
-                            car_dict,
-                            mileage_plus_minus,
-                        )
-                else:
-                    for site_to_scrape in updated_sites_to_scrape:
-                        if site_to_scrape in domain_functions:
-                            executor.submit(
-                                domain_functions[site_to_scrape],
-                                car_dict,
-                                mileage_plus_minus,
-                            )
-
-            # verify status
-            if (row_id + 1) == len(df):
-                stats = "success"
-                stopped_at = datetime.now().isoformat()
-            else:
-                stopped_at = None
-                stats = "running"
-
-            client.table("Status").update(
-                {
-                    "id": 1,
-                    "status": stats,
-                    "stopped_at": stopped_at,
-                    "total_completed": row_id + 1,
-                    "total_running": len(df),
-                }
-            ).eq("id", 1).execute()
+        run_id, params = runstate.begin(
+            run_id or uuid4().hex,
+            {
+                "mileage_plus_minus": mileage_plus_minus,
+                "ignore_old": ignore_old,
+                "sites_to_scrape": sites_to_scrape,
+                "dev": dev,
+                "car_id": car_id,
+            },
+            resume,
+        )
+        generation = runstate.new_generation(run_id)
+        mileage_plus_minus = params["mileage_plus_minus"]
+        _, jobs = plan_jobs(
+            params["ignore_old"],
+            params["sites_to_scrape"],
+            params["dev"],
+            params["car_id"],
+            run_id,
+        )
+        start_progress(run_id, jobs)
+
+        # Rows are pipelined: every (row, site) job goes to the scheduler and
+        # only the number of rows in flight is bounded
+        pending: dict[int, list[Future]] = {}
+        with SiteScheduler() as scheduler:
+            for row_id, (car_dict, row_sites) in enumerate(jobs):
+                if runstate.is_stopped(run_id):
+                    print(f"Run {run_id} stopped at row {row_id}")
+                    break
+                # Each site gets its own copy since the services mutate it
+                pending[row_id] = [
+                    scheduler.submit(
+                        site,
+                        run_job,
+                        run_id,
+                        site,
+                        deepcopy(car_dict),
+                        mileage_plus_minus,
+                        generation=generation,
+                    )
+                    for site in row_sites
+                ]
+
+                if len(pending) >= config.MAX_PENDING_ROWS:
+                    pop_completed_rows(pending)
+
+            while pending:
+                pop_completed_rows(pending)
+        write_buffer.flush()
+        print(f"Writes - {write_buffer.stats()}")
+
+        if runstate.is_stopped(run_id):
+            return
+        finish_run(run_id, "success")
 
     except Exception as e:
         print(f"Error: {e}")
-        client.table("Status").update(
+        set_status(
             {
-                "id": 1,
                 "status": "failed",
                 "stopped_at": datetime.now().isoformat(),
             }
-        ).eq("id", 1).execute()
+        )
+        if run_id:
+            progress.finish(run_id, "failed")
         raise e
 
 
@@ -181,6 +341,7 @@ if __name__ == "__main__":
     args.add_argument("--ignore-old", action="store_true")
     args.add_argument("--sites-to-scrape", type=str, default="leboncoin:lacentrale")
     args.add_argument("--car-id", type=int, default=None)
+    args.add_argument("--resume", action="store_true")
     parsed_args = args.parse_args()
     print(parsed_args)
 
@@ -190,4 +351,5 @@ if __name__ == "__main__":
         ignore_old=parsed_args.ignore_old,
         sites_to_scrape=parsed_args.sites_to_scrape.split(":"),
         car_id=parsed_args.car_id,
+        resume=parsed_args.resume,
     )
@@ -0,0 +1,281 @@
+"""
+Load test of the api against a local stand-in for PostgREST, reporting the
+requests per second and latency percentiles of every endpoint.
+
+The stand-in answers on port 8000 like the Supabase gateway, with a delay per
+table to play a slow database. The api runs in its own uvicorn process from
+--app-dir, so a previous revision can be measured from a worktree:
+
+    git worktree add /tmp/api-before <revision>
+    python -m benchmarks.api_load --app-dir /tmp/api-before
+    python -m benchmarks.api_load
+
+The mixed scenario floods /get_all_cars while /scrape_status is polled, which
+shows whether slow listings starve the other endpoints. Redis should be
+reachable on CACHE_REDIS_URL as in production.
+"""
+
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from multiprocessing import Process
+from pathlib import Path
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+FAKE_PORT = 8000
+# Any three part token passes the key check of the client
+FAKE_KEY = "header.payload.signature"
+sites = ["lacentrale", "autoscout24", "leboncoin"]
+
+
+def make_vehicles(count: int, seed: int = 0) -> list[dict]:
+    random.seed(seed)
+    vehicles = []
+    for idx in range(1, count + 1):
+        price = random.randint(8000, 40000)
+        vehicle = {
+            "id": idx,
+            "make": random.choice(["PEUGEOT", "RENAULT", "BMW"]),
+            "model": random.choice(["208", "CLIO", "X1"]),
+            "price_with_tax": price,
+            "comparisons": [],
+        }
+        for site in sites:
+            matches = [
+                [random.randint(80, 100), price + random.randint(-3000, 3000), ""]
+                for _ in range(5)
+            ]
+            matches.sort(key=lambda match: match[0], reverse=True)
+            vehicle[f"{site}_stats"] = {"matches": matches, "updated_at": None}
+        vehicles.append(vehicle)
+    return vehicles
+
+
+def make_fake_app(vehicles: list[dict], latencies: dict[str, float]) -> Starlette:
+    status = [{"id": 1, "status": "success", "total_completed": 0}]
+
+    def filter_vehicles(request: Request) -> list[dict]:
+        rows = vehicles
+        id_filter = request.query_params.get("id", "")
+        if id_filter.startswith("gt."):
+            rows = [row for row in rows if row["id"] > int(id_filter[3:])]
+        elif id_filter.startswith("in."):
+            ids = {int(value) for value in re.findall(r"\d+", id_filter)}
+            rows = [row for row in rows if row["id"] in ids]
+        for column in ["make", "model"]:
+            value = request.query_params.get(column, "")
+            if value.startswith("ilike."):
+                value = value[6:].replace("\\", "").upper()
+                rows = [row for row in rows if row[column].upper() == value]
+        return rows
+
+    def page(request: Request, rows: list[dict]) -> list[dict]:
+        offset = int(request.query_params.get("offset", 0))
+        limit = int(request.query_params.get("limit", len(rows)))
+        return rows[offset : offset + limit]
+
+    async def table(request: Request) -> Response:
+        name = request.path_params["table"]
+        await asyncio.sleep(latencies.get(name, 0))
+        if request.method == "PATCH":
+            status[0].update(json.loads(await request.body()))
+            return Response(json.dumps(status), media_type="application/json")
+        matched = filter_vehicles(request) if name == "Vehicles" else status
+        rows = page(request, matched)
+        headers = {}
+        if "count=exact" in request.headers.get("prefer", ""):
+            total = len(matched)
+            headers["Content-Range"] = f"0-{max(len(rows) - 1, 0)}/{total}"
+        return Response(
+            json.dumps(rows), media_type="application/json", headers=headers
+        )
+
+    return Starlette(
+        routes=[Route("/rest/v1/{table}", table, methods=["GET", "PATCH", "HEAD"])]
+    )
+
+
+def serve_fake(vehicles_count: int, latencies: dict[str, float]):
+    app = make_fake_app(make_vehicles(vehicles_count), latencies)
+    uvicorn.run(app, host="127.0.0.1", port=FAKE_PORT, log_level="warning")
+
+
+def uvicorn_command(port: int, args: list[str]) -> list[str]:
+    return [sys.executable, "-m", "uvicorn", "api:app", "--port", str(port)] + args
+
+
+def start_api(app_dir: Path, command: list[str]) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "SUPABASE_URL": "127.0.0.1",
+        "SUPABASE_KEY": FAKE_KEY,
+    }
+    return subprocess.Popen(
+        command,
+        cwd=app_dir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def wait_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def percentile(values: list[float], ratio: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+async def load(
+    client: httpx.AsyncClient,
+    make_path,
+    clients: int,
+    duration: float,
+    results: dict,
+):
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        while time.monotonic() < deadline:
+            path = make_path()
+            name = path.split("?")[0]
+            result = results.setdefault(name, {"latencies": [], "codes": {}})
+            start = time.perf_counter()
+            try:
+                response = await client.get(path)
+                code = response.status_code
+            except httpx.HTTPError as e:
+                code = type(e).__name__
+            result["latencies"].append(time.perf_counter() - start)
+            result["codes"][code] = result["codes"].get(code, 0) + 1
+
+    await asyncio.gather(*[worker() for _ in range(clients)])
+
+
+def listing_path(vehicles: int):
+    # Random cursors so pages miss the response cache
+    return lambda: f"/get_all_cars?limit=20&cursor={random.randint(0, vehicles)}"
+
+
+def status_path():
+    return "/scrape_status"
+
+
+async def run_scenarios(
+    base_url: str, vehicles: int, clients: int, duration: float
+) -> dict:
+    scenarios = {
+        "get_all_cars": [(listing_path(vehicles), clients)],
+        "scrape_status": [(status_path, clients)],
+        "mixed": [
+            (listing_path(vehicles), clients),
+            (status_path, max(clients // 4, 1)),
+        ],
+    }
+    limits = httpx.Limits(max_connections=clients * 2)
+    reports = {}
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=120
+    ) as client:
+        for scenario, loads in scenarios.items():
+            results = {}
+            await asyncio.gather(
+                *[
+                    load(client, make_path, count, duration, results)
+                    for make_path, count in loads
+                ]
+            )
+            reports[scenario] = {
+                name: {
+                    "requests": len(result["latencies"]),
+                    "rps": len(result["latencies"]) / duration,
+                    "p50_ms": percentile(result["latencies"], 0.5) * 1000,
+                    "p99_ms": percentile(result["latencies"], 0.99) * 1000,
+                    "codes": result["codes"],
+                }
+                for name, result in results.items()
+            }
+    return reports
+
+
+def print_reports(reports: dict, prefix: str = ""):
+    for scenario, report in reports.items():
+        for name, result in report.items():
+            print(
+                f"{prefix}{scenario} {name}: {result['rps']:.1f} req/s, "
+                f"p50 {result['p50_ms']:.0f} ms, p99 {result['p99_ms']:.0f} ms, "
+                f"codes {result['codes']}"
+            )
+
+
+def run(
+    app_dir: Path,
+    command: list[str],
+    port: int,
+    vehicles: int,
+    clients: int,
+    duration: float,
+    latencies: dict[str, float],
+) -> dict:
+    fake = Process(target=serve_fake, args=(vehicles, latencies), daemon=True)
+    fake.start()
+    api = start_api(app_dir, command)
+    try:
+        wait_ready(f"http://127.0.0.1:{FAKE_PORT}/rest/v1/Status")
+        wait_ready(f"http://127.0.0.1:{port}/openapi.json")
+        return asyncio.run(
+            run_scenarios(f"http://127.0.0.1:{port}", vehicles, clients, duration)
+        )
+    finally:
+        api.terminate()
+        api.wait()
+        fake.terminate()
+
+
+if __name__ == "__main__":
+    args = ArgumentParser()
+    args.add_argument("--app-dir", type=Path, default=Path(__file__).parents[1])
+    args.add_argument("--port", type=int, default=8600)
+    args.add_argument("--vehicles", type=int, default=5000)
+    args.add_argument("--clients", type=int, default=64)
+    args.add_argument("--duration", type=float, default=15)
+    args.add_argument("--vehicles-latency", type=float, default=0.5)
+    args.add_argument("--status-latency", type=float, default=0.01)
+    parsed_args, uvicorn_args = args.parse_known_args()
+
+    reports = run(
+        parsed_args.app_dir.resolve(),
+        uvicorn_command(parsed_args.port, uvicorn_args),
+        parsed_args.port,
+        parsed_args.vehicles,
+        parsed_args.clients,
+        parsed_args.duration,
+        {
+            "Vehicles": parsed_args.vehicles_latency,
+            "Status": parsed_args.status_latency,
+        },
+    )
+    print_reports(reports)
@@ -0,0 +1,63 @@
+"""
+Replay a recorded match corpus through the local pre-scorer.
+
+Record the corpus by running the scraper with MATCH_CORPUS_FILE set, every
+candidate then goes to the LLM and its score is appended to the file.
+
+    python -m benchmarks.local_scoring corpus.jsonl --accept 90 --reject 60
+"""
+
+import json
+from argparse import ArgumentParser
+
+from config import config
+from utilities import scoring
+
+
+def run(corpus_path: str, accept: float, reject: float) -> dict:
+    with open(corpus_path, "r", encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+
+    decided = 0
+    accepted = 0
+    rejected = 0
+    drifts = []
+    decided_drifts = []
+    for line in lines:
+        local_score = scoring.pre_score(line["car_dict"], line["car"])
+        drift = abs(local_score.score - line["matching_percentage"])
+        drifts.append(drift)
+        if local_score.is_match(accept):
+            accepted += 1
+        elif local_score.is_mismatch(reject):
+            rejected += 1
+        else:
+            continue
+        decided += 1
+        decided_drifts.append(drift)
+
+    def mean(values: list[float]) -> float:
+        return sum(values) / len(values) if values else 0
+
+    return {
+        "total": len(lines),
+        "llm_calls_saved": decided,
+        "llm_calls_saved_ratio": decided / len(lines) if lines else 0,
+        "accepted_locally": accepted,
+        "rejected_locally": rejected,
+        "mean_drift_decided": mean(decided_drifts),
+        "max_drift_decided": max(decided_drifts, default=0),
+        "mean_drift_all": mean(drifts),
+    }
+
+
+if __name__ == "__main__":
+    args = ArgumentParser()
+    args.add_argument("corpus", type=str)
+    args.add_argument("--accept", type=float, default=config.LOCAL_MATCH_ACCEPT)
+    args.add_argument("--reject", type=float, default=config.LOCAL_MATCH_REJECT)
+    parsed_args = args.parse_args()
+
+    report = run(parsed_args.corpus, parsed_args.accept, parsed_args.reject)
+    for key, value in report.items():
+        print(f"{key}: {round(value, 2)}")
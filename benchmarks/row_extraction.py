@@ -0,0 +1,80 @@
+"""
+Compare the per-row get_row_dict with the columnar get_row_dicts on a
+synthetic sheet shaped like the upload file.
+
+    python -m benchmarks.row_extraction --rows 50000
+"""
+
+import contextlib
+import io
+import random
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+import pandas as pd
+
+from utilities import utils
+
+
+def make_sheet(rows: int, width: int = 400, seed: int = 0) -> pd.DataFrame:
+    random.seed(seed)
+    makes = ["PEUGEOT", "RENAULT", "VOLKSWAGEN", "BMW", "AUDI", "DS"]
+    dates = [datetime(year, month, 1) for year in range(2015, 2025) for month in (1, 6)]
+    dates += ["03/2019", "2021", "01.02.2018", 0, "unknown"]
+    data = {}
+    for idx in range(width):
+        data[utils.numeric_to_alphabetic_column_name(idx)] = [0] * rows
+    data["B"] = list(range(100000, 100000 + rows))
+    data["D"] = [random.choice(makes) for _ in range(rows)]
+    data["E"] = [f"MODEL {random.randint(1, 40)}" for _ in range(rows)]
+    data["I"] = [random.choice(dates) for _ in range(rows)]
+    data["J"] = [random.randint(0, 200000) for _ in range(rows)]
+    data["K"] = [random.randint(5000, 60000) for _ in range(rows)]
+    data["DF"] = [random.choice([1, 2, 6, 7]) for _ in range(rows)]
+    data["DG"] = [random.choice([0, 1, 2]) for _ in range(rows)]
+    for column in utils.equipment_columns.values():
+        data[column] = [random.choice([0, 1, 1.0, "x"]) for _ in range(rows)]
+    for column in utils.flag_columns.values():
+        data[column] = [random.choice([0, 1]) for _ in range(rows)]
+    data["KC"] = [f"VERSION {random.randint(1, 100)}" for _ in range(rows)]
+    data["OH"] = [random.choice(["NOIR", "BLANC", "GRIS"]) for _ in range(rows)]
+    return pd.DataFrame(data)
+
+
+def run(rows: int, compare_rows: int | None = None) -> dict:
+    df = make_sheet(rows)
+
+    start = time.perf_counter()
+    new_dicts = utils.get_row_dicts(df)
+    new_seconds = time.perf_counter() - start
+
+    # The per-row path is slow, time it on a slice and extrapolate
+    compare_rows = min(compare_rows or rows, rows)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        old_dicts = [utils.get_row_dict(df, row_id) for row_id in range(compare_rows)]
+    old_seconds = (time.perf_counter() - start) * rows / compare_rows
+
+    mismatches = sum(
+        [old != new for old, new in zip(old_dicts, new_dicts[:compare_rows])]
+    )
+    return {
+        "rows": rows,
+        "get_row_dict_seconds": old_seconds,
+        "get_row_dicts_seconds": new_seconds,
+        "speedup": old_seconds / new_seconds if new_seconds else 0,
+        "compared_rows": compare_rows,
+        "mismatches": mismatches,
+    }
+
+
+if __name__ == "__main__":
+    args = ArgumentParser()
+    args.add_argument("--rows", type=int, default=50000)
+    args.add_argument("--compare-rows", type=int, default=None)
+    parsed_args = args.parse_args()
+
+    report = run(parsed_args.rows, parsed_args.compare_rows)
+    for key, value in report.items():
+        print(f"{key}: {round(value, 2)}")
@@ -0,0 +1,55 @@
+"""
+Throughput of the api under `fastapi dev` against the production profile of
+serve.py, both in front of the PostgREST stand-in of api_load.
+
+    python -m benchmarks.serve_modes --workers 4
+
+The database answers fast by default so the serving layer, not the queries,
+bounds the results.
+"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+from benchmarks import api_load
+
+
+def get_commands(port: int, workers: int) -> dict[str, list[str]]:
+    return {
+        "dev": [sys.executable, "-m", "fastapi", "dev", "api.py", "--port", str(port)],
+        "prod": [
+            sys.executable,
+            "serve.py",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+        ],
+    }
+
+
+if __name__ == "__main__":
+    args = ArgumentParser()
+    args.add_argument("--app-dir", type=Path, default=Path(__file__).parents[1])
+    args.add_argument("--port", type=int, default=8600)
+    args.add_argument("--workers", type=int, default=4)
+    args.add_argument("--vehicles", type=int, default=5000)
+    args.add_argument("--clients", type=int, default=64)
+    args.add_argument("--duration", type=float, default=15)
+    args.add_argument("--latency", type=float, default=0.005)
+    parsed_args = args.parse_args()
+
+    latencies = {"Vehicles": parsed_args.latency, "Status": parsed_args.latency}
+    commands = get_commands(parsed_args.port, parsed_args.workers)
+    for mode, command in commands.items():
+        reports = api_load.run(
+            parsed_args.app_dir.resolve(),
+            command,
+            parsed_args.port,
+            parsed_args.vehicles,
+            parsed_args.clients,
+            parsed_args.duration,
+            latencies,
+        )
+        api_load.print_reports(reports, f"{mode} ")
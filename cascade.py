@@ -0,0 +1,163 @@
+import asyncio
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from browser import afetch_listing, score_cars
+from config import config
+from model.model import Car
+from utilities import fetch, metrics
+
+# Returns the number of hits of a filter url and, when the probe had to
+# download it anyway, the listing payload itself
+Probe = Callable[[str], Awaitable[tuple[int | None, Any]]]
+
+
+class ListingSearch:
+    """
+    Counts and fetches the filter urls of one car, ordered from the most
+    specific to the basic one. Every request is made at most once.
+    """
+
+    def __init__(
+        self,
+        site: str,
+        car_dict: dict,
+        filter_urls: list[str],
+        domain: str,
+        extract_10_cars,
+        probe: Probe | None = None,
+    ):
+        self.site = site
+        self.car_dict = car_dict
+        self.filter_urls = filter_urls
+        self.domain = domain
+        self.extract_10_cars = extract_10_cars
+        self.probe = probe
+        self.payloads: dict[int, Any] = {}
+        self.loaded: dict[int, list[Car]] = {}
+        self.counts: dict[int, int] = {}
+        self.full_fetches = 0
+
+    @property
+    def last(self) -> int:
+        return len(self.filter_urls) - 1
+
+    async def load(self, idx: int) -> list[Car]:
+        if idx not in self.loaded:
+            print(f"Filter url - {self.filter_urls[idx]}")
+            payload = self.payloads.pop(idx, None)
+            if payload is None:
+                payload = await afetch_listing(self.filter_urls[idx], self.domain)
+                self.full_fetches += 1
+            self.loaded[idx] = self.extract_10_cars(
+                payload, self.domain, self.car_dict["id"], datetime.now().isoformat()
+            )
+            print(f"Found - {len(self.loaded[idx])} cars")
+        return self.loaded[idx]
+
+    async def count(self, idx: int) -> int:
+        if idx in self.counts:
+            return self.counts[idx]
+        count = None
+        if self.probe and (idx not in self.loaded):
+            try:
+                count, payload = await self.probe(self.filter_urls[idx])
+                if payload is not None:
+                    self.payloads[idx] = payload
+                    self.full_fetches += 1
+                else:
+                    metrics.incr("cascade", f"{self.site}:probes")
+                print(f"Probe - {count} hits - {self.filter_urls[idx]}")
+            except Exception as e:
+                print(f"Probe error - {e}")
+        if count is None:
+            count = len(await self.load(idx))
+        self.counts[idx] = count
+        return count
+
+    async def select(self, idx: int) -> list[Car]:
+        # Probe counts include ads dropped by the extraction (our own ads),
+        # so fall back to the next urls when the page has fewer than 10 cars
+        for next_idx in range(idx, len(self.filter_urls)):
+            ten_cars = await self.load(next_idx)
+            if (len(ten_cars) >= 10) or (next_idx == self.last):
+                self.report(next_idx)
+                return ten_cars
+        return []
+
+    def report(self, idx: int):
+        # A linear walk would have fetched every url up to the selected one
+        avoided = max(0, idx + 1 - self.full_fetches)
+        metrics.incr("cascade", f"{self.site}:full_fetches", self.full_fetches)
+        metrics.incr("cascade", f"{self.site}:full_fetches_avoided", avoided)
+        print(f"Full fetches - {self.full_fetches}, avoided - {avoided}")
+
+
+async def aspeculative_search(search: ListingSearch, width: int = 1) -> list[Car]:
+    """
+    Count up to `width` filter urls at once and keep the most specific one
+    returning 10 cars, or the basic filter.
+    """
+    tasks: dict[int, asyncio.Task] = {}
+    next_idx = 0
+    selected = None
+    try:
+        for idx in range(len(search.filter_urls)):
+            while (next_idx <= search.last) and (next_idx < idx + max(width, 1)):
+                tasks[next_idx] = asyncio.create_task(search.count(next_idx))
+                next_idx += 1
+            count = await tasks.pop(idx)
+            if (count >= 10) or (idx == search.last):
+                selected = idx
+                break
+    finally:
+        # The less specific urls still in flight are not needed anymore
+        for task in tasks.values():
+            task.cancel()
+    if selected is None:
+        return []
+    return await search.select(selected)
+
+
+async def abinary_search(search: ListingSearch, width: int = 1) -> list[Car]:
+    """
+    Every filter url adds one filter to the next one, so the number of hits
+    only grows from the most specific url to the basic one. Search for the
+    most specific url still returning 10 cars, probing `width` urls per round.
+    """
+    if not search.filter_urls:
+        return []
+    # The basic filter at `high` is always accepted
+    low, high = 0, search.last
+    while low < high:
+        step = (high - low) / (max(width, 1) + 1)
+        probes = sorted({low + int(step * (i + 1)) for i in range(max(width, 1))})
+        counts = await asyncio.gather(*[search.count(idx) for idx in probes])
+        for idx, count in zip(probes, counts):
+            if count >= 10:
+                high = idx
+                break
+            low = idx + 1
+    return await search.select(high)
+
+
+search_strategies = {
+    "speculative": aspeculative_search,
+    "binary": abinary_search,
+}
+
+
+def search_cars(
+    site: str,
+    car_dict: dict,
+    filter_urls: list[str],
+    domain: str,
+    extract_10_cars,
+    probe: Probe | None = None,
+) -> list[Car]:
+    search = ListingSearch(site, car_dict, filter_urls, domain, extract_10_cars, probe)
+    width = config.CASCADE_WIDTH.get(site, 1)
+    strategy = search_strategies[config.FILTER_SEARCH_STRATEGY.get(site, "speculative")]
+    ten_cars = fetch.run(strategy(search, width))
+    print(f"Total cars - {len(ten_cars)}")
+    return score_cars(car_dict, ten_cars, car_dict["id"])
@@ -1,10 +1,16 @@
-from celery import Celery
+from datetime import datetime
+
+from celery import Celery, chord
+from celery.signals import worker_process_init, worker_process_shutdown
 from config import config
+from utilities import db, runstate
+from utilities.writer import write_buffer
 
 # Create Celery app instance
 celery_app = Celery(
     "auto_app",
     broker=config.CELERY_BROKER_URL,
+    backend=config.CELERY_RESULT_BACKEND,
 )
 
 # Celery configuration
@@ -15,9 +21,28 @@ celery_app.conf.update(
     enable_utc=True,
     task_track_started=True,
     worker_prefetch_multiplier=1,  # Process one task at a time
+    task_default_queue="celery",
+    result_expires=config.RUN_STATE_TTL,
 )
 
 
+@worker_process_init.connect
+def init_worker_process(**_):
+    # Each forked worker process gets its own Supabase client pool
+    db.init_pool()
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**_):
+    write_buffer.flush()
+    db.close_pool()
+
+
+def site_queue(site: str) -> str:
+    # Every site has its own queue so its workers scale independently
+    return f"{config.CELERY_SITE_QUEUE_PREFIX}{site}"
+
+
 @celery_app.task(bind=True, name="celery_app.start_services_task")
 def start_services_task(
     self,
@@ -26,23 +51,100 @@ def start_services_task(
     sites_to_scrape: list[str],
     dev: bool = True,
     car_id: int | str | None = None,
+    resume: bool = False,
 ):
-    from app import start_services
+    """
+    Plans the run then fans it out as one task per (vehicle, site) on the
+    site queues, the chord callback closes the run once they are all done.
+    A resumed run keeps its id and only dispatches the jobs not done yet.
+    """
+    from app import plan_jobs, set_status, start_progress
 
+    self.update_state(state="RUNNING", meta={"status": "Scraping in progress"})
     try:
-        # Update task state to indicate it's running
-        self.update_state(state="RUNNING", meta={"status": "Scraping in progress"})
-
-        # Call start_services function
-        start_services(
-            mileage_plus_minus=mileage_plus_minus,
-            ignore_old=ignore_old,
-            sites_to_scrape=sites_to_scrape,
-            dev=dev,
-            car_id=car_id,
+        run_id, params = runstate.begin(
+            self.request.id,
+            {
+                "mileage_plus_minus": mileage_plus_minus,
+                "ignore_old": ignore_old,
+                "sites_to_scrape": sites_to_scrape,
+                "dev": dev,
+                "car_id": car_id,
+            },
+            resume,
         )
-
-        return {"status": "completed", "message": "Scraping completed successfully"}
+        runstate.link_task(self.request.id, run_id)
+        generation = runstate.new_generation(run_id)
+        _, jobs = plan_jobs(
+            params["ignore_old"],
+            params["sites_to_scrape"],
+            params["dev"],
+            params["car_id"],
+            run_id,
+        )
+        header = [
+            scrape_vehicle_task.si(
+                run_id=run_id,
+                car_dict=car_dict,
+                site=site,
+                mileage_plus_minus=params["mileage_plus_minus"],
+                generation=generation,
+            ).set(queue=site_queue(site))
+            for car_dict, row_sites in jobs
+            for site in row_sites
+        ]
+        total = start_progress(run_id, jobs)
+        callback = finalize_run_task.s(run_id=run_id, generation=generation)
+        if header:
+            chord(header)(callback)
+        else:
+            callback.delay([])
+        print(f"Dispatched - {len(header)} jobs, {total - len(header)} already done")
+        return {"status": "dispatched", "run_id": run_id, "jobs": len(header)}
 
     except Exception as e:
+        print(f"Error: {e}")
+        set_status({"status": "failed", "stopped_at": datetime.now().isoformat()})
         raise e
+
+
+@celery_app.task(
+    bind=True,
+    name="celery_app.scrape_vehicle_task",
+    acks_late=True,
+    reject_on_worker_lost=True,
+)
+def scrape_vehicle_task(
+    self,
+    run_id: str,
+    car_dict: dict,
+    site: str,
+    mileage_plus_minus: int,
+    generation: int | None = None,
+):
+    from app import run_job
+
+    # A failure must not break the chord, it is only reported to the callback.
+    # The rows are written before the task is acked, a lost worker loses none
+    status = run_job(
+        run_id, site, car_dict, mileage_plus_minus, flush=True, generation=generation
+    )
+    return {"id": car_dict["id"], "site": site, "status": status}
+
+
+@celery_app.task(name="celery_app.finalize_run_task")
+def finalize_run_task(results: list[dict], run_id: str, generation: int | None = None):
+    from app import finish_run
+
+    # The chord of a dispatch the run was resumed over closes nothing
+    if not runstate.is_current(run_id, generation):
+        print(f"Run {run_id} - stale dispatch {generation}, skipped")
+        return {"total": len(results), "stale": len(results)}
+
+    summary = {"total": len(results)}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    print(f"Run {run_id} - {summary}")
+    if not runstate.is_stopped(run_id):
+        finish_run(run_id, "success")
+    return summary
@@ -0,0 +1,108 @@
+from argparse import ArgumentParser
+from pathlib import Path
+
+from config import config
+from browser import filter_cache
+from services import autoscout24, lacentrale, leboncoin
+from utilities import db, listing, metrics, sheet, taxonomy
+
+taxonomy_functions = {
+    "lacentrale": lambda make: lacentrale.get_taxonomy(lacentrale.normalize_make(make)),
+    "autoscout24": autoscout24.get_taxonomy,
+    "leboncoin": leboncoin.get_taxonomy,
+}
+
+
+def get_makes_from_sheet() -> list[str]:
+    records = sheet.load_records(Path(config.UPLOAD_FILE))
+    makes = {str(record["make"]).strip() for record in records}
+    return sorted([make for make in makes if make and make != "0"])
+
+
+def warm_taxonomy(sites: list[str], makes: list[str], refresh: bool = False):
+    for site in sites:
+        for make in makes:
+            if refresh:
+                taxonomy.invalidate(site, make)
+            try:
+                taxonomy_functions[site](make)
+                print(f"Warmed - {site}:{make}")
+            except Exception as e:
+                print(f"Warm up error - {site}:{make} - {e}")
+
+
+def backfill_stats(batch_size: int = 200) -> int:
+    # Summaries of the vehicles scraped before the stats columns existed
+    cursor = None
+    total = 0
+    while True:
+        with db.session() as client:
+            stmt = (
+                client.table("Vehicles")
+                .select("id, comparisons(*)")
+                .order("id")
+                .limit(batch_size)
+            )
+            if cursor is not None:
+                stmt = stmt.gt("id", cursor)
+            rows = stmt.execute().data
+        if not rows:
+            return total
+        updates = []
+        for row in rows:
+            site_cars = {}
+            for comparison in row["comparisons"]:
+                site = listing.site_of(comparison.get("domain") or "")
+                if site in listing.stats_sites:
+                    site_cars.setdefault(site, []).append(comparison)
+            if site_cars:
+                stats = {
+                    listing.stats_column(site): listing.summarize(cars)
+                    for site, cars in site_cars.items()
+                }
+                updates.append({"id": row["id"], **stats})
+        if updates:
+            db.upsert("Vehicles", updates)
+        total += len(updates)
+        cursor = rows[-1]["id"]
+        print(f"Backfilled - {total} vehicles")
+
+
+if __name__ == "__main__":
+    args = ArgumentParser()
+    commands = args.add_subparsers(dest="command", required=True)
+
+    warm_args = commands.add_parser("warm-taxonomy")
+    warm_args.add_argument("--sites", type=str, default=":".join(taxonomy_functions))
+    warm_args.add_argument("--makes", type=str, default=None)
+    warm_args.add_argument("--refresh", action="store_true")
+
+    clear_args = commands.add_parser("clear-taxonomy")
+    clear_args.add_argument("--site", type=str, default=None)
+    clear_args.add_argument("--make", type=str, default=None)
+
+    commands.add_parser("clear-filters")
+    backfill_args = commands.add_parser("backfill-stats")
+    backfill_args.add_argument("--batch-size", type=int, default=200)
+    commands.add_parser("stats")
+
+    parsed_args = args.parse_args()
+    if parsed_args.command == "warm-taxonomy":
+        makes = (
+            parsed_args.makes.split(":")
+            if parsed_args.makes
+            else get_makes_from_sheet()
+        )
+        warm_taxonomy(parsed_args.sites.split(":"), makes, parsed_args.refresh)
+    elif parsed_args.command == "clear-taxonomy":
+        total = taxonomy.invalidate(parsed_args.site, parsed_args.make)
+        print(f"Cleared - {total} taxonomy entries")
+    elif parsed_args.command == "clear-filters":
+        total = filter_cache.clear()
+        print(f"Cleared - {total} filter entries")
+    elif parsed_args.command == "backfill-stats":
+        total = backfill_stats(parsed_args.batch_size)
+        print(f"Backfilled - {total} vehicles")
+    elif parsed_args.command == "stats":
+        print(f"Filter cache - {metrics.hit_ratio('filter_cache')}")
+        print(f"Cascade - {metrics.get('cascade')}")
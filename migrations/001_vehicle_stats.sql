@@ -0,0 +1,6 @@
+-- Summaries of the comparisons of each site, written by utils.parse_and_save.
+-- Fill the rows scraped before this migration with:
+--   python manage.py backfill-stats
+alter table "Vehicles" add column if not exists lacentrale_stats jsonb;
+alter table "Vehicles" add column if not exists autoscout24_stats jsonb;
+alter table "Vehicles" add column if not exists leboncoin_stats jsonb;
@@ -34,3 +34,13 @@ class Filter(BaseModel):
 class Match(BaseModel):
     matching_percentage: float
     matching_percentage_reason: Optional[str]
+
+
+class IndexedMatch(BaseModel):
+    index: int
+    matching_percentage: float
+    matching_percentage_reason: Optional[str]
+
+
+class MatchBatch(BaseModel):
+    matches: list[IndexedMatch]
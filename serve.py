@@ -0,0 +1,45 @@
+"""
+Production server of the api, `fastapi dev api.py` stays for development.
+
+    python serve.py --workers 4
+
+Runs API_WORKERS uvicorn processes on uvloop and httptools. On SIGTERM every
+worker stops accepting connections and gets API_GRACEFUL_TIMEOUT seconds to
+finish the requests in flight before its pools are closed.
+"""
+
+from argparse import ArgumentParser
+
+import uvicorn
+
+from config import config
+
+
+def get_options(workers: int | None = None, port: int | None = None) -> dict:
+    return {
+        "host": config.API_HOST,
+        "port": port or config.API_PORT,
+        "workers": workers or config.API_WORKERS,
+        "loop": "uvloop",
+        "http": "httptools",
+        "lifespan": "on",
+        "timeout_keep_alive": config.API_KEEPALIVE,
+        "timeout_graceful_shutdown": config.API_GRACEFUL_TIMEOUT,
+        "backlog": config.API_BACKLOG,
+        "access_log": config.API_ACCESS_LOG,
+        # Client addresses come from the proxy in front, when it is trusted
+        "proxy_headers": True,
+        "forwarded_allow_ips": config.API_FORWARDED_ALLOW_IPS,
+    }
+
+
+if __name__ == "__main__":
+    args = ArgumentParser()
+    args.add_argument("--workers", type=int, default=None)
+    args.add_argument("--port", type=int, default=None)
+    parsed_args = args.parse_args()
+
+    options = get_options(parsed_args.workers, parsed_args.port)
+    print(f"Serving api - {options['workers']} workers on port {options['port']}")
+    # The app goes by its import path so every worker process loads its own
+    uvicorn.run("api:app", **options)
@@ -1,12 +1,12 @@
-from browser import client, types, HEADERS
+import cascade
+from browser import get_car_filter
 from model.model import Filter, Car
-from utilities import utils
-from browser import get_the_listing_html
+from utilities import fetch, taxonomy, utils
 import json
 from selectolax.parser import HTMLParser
-import httpx
 from urllib.parse import urlencode, urlunparse, ParseResult
 
+site = "autoscout24"
 domain = "https://www.autoscout24.fr/"
 
 
@@ -93,48 +93,43 @@ def user_prompt(models: dict, colors: dict, fuel_types: dict, target_dict: dict)
         """
 
 
-def get_prompt_from_make(input_dict: dict) -> str:
+@taxonomy.cached_taxonomy("autoscout24")
+def get_taxonomy(make: str) -> dict | None:
     print("Sending requests to get the models and colors")
-    input_url = (
-        f"https://www.autoscout24.fr/lst/{input_dict['make'].replace(' ', '-').lower()}"
-    )
+    input_url = f"https://www.autoscout24.fr/lst/{make.replace(' ', '-').lower()}"
     print(input_url)
-    json_data = {
-        "url": input_url,
-        "geo": "France",
-        "device_type": "mobile",
-    }
-    response = httpx.post(
-        "https://scraper-api.decodo.com/v2/scrape",
-        headers=HEADERS,
-        timeout=None,
-        json=json_data,
-    )
-    response.raise_for_status()
-    json_data = response.json()
-    if json_data.get("results"):
-        content = json_data.get("results")[0]["content"]
+    content = fetch.decodo_scrape(input_url, headless=False)
     soup = HTMLParser(content)
     json_str = soup.css_first('script[id="__NEXT_DATA__"]').text()
     json_data = json.loads(json_str)
-    taxonomy = json_data["props"]["pageProps"]["taxonomy"]
-    makes = taxonomy["makeLabels"]
-    all_models = {}
-    all_colors = {}
-    fuel_types = {}
+    taxonomy_data = json_data["props"]["pageProps"]["taxonomy"]
+    makes = taxonomy_data["makeLabels"]
     for x in makes:
-        if makes[x].lower() == input_dict["make"].lower():
-            models = taxonomy["models"][x]
-            for model in models:
-                all_models[model["label"]] = model["value"]
-            colors = taxonomy["bodyColor"]
-            for color in colors:
-                all_colors[color["label"]] = color["value"]
-            fuels = taxonomy["fuelType"]
-            for fuel in fuels:
-                fuel_types[fuel["label"]] = fuel["value"]
-            break
-    return user_prompt(all_models, all_colors, fuel_types, input_dict)
+        if makes[x].lower() == make.lower():
+            return {
+                "models": {
+                    model["label"]: model["value"]
+                    for model in taxonomy_data["models"][x]
+                },
+                "colors": {
+                    color["label"]: color["value"]
+                    for color in taxonomy_data["bodyColor"]
+                },
+                "fuel_types": {
+                    fuel["label"]: fuel["value"] for fuel in taxonomy_data["fuelType"]
+                },
+            }
+    return None
+
+
+def get_prompt_from_make(input_dict: dict) -> str:
+    make_taxonomy = get_taxonomy(input_dict["make"]) or {}
+    return user_prompt(
+        make_taxonomy.get("models", {}),
+        make_taxonomy.get("colors", {}),
+        make_taxonomy.get("fuel_types", {}),
+        input_dict,
+    )
 
 
 def get_options(car_dict: dict):
@@ -199,19 +194,21 @@ def get_filter_url(params: dict, car_dict: dict, car_filter: Filter) -> str:
     return filter_url
 
 
+async def aprobe_count(filter_url: str) -> tuple[int | None, None]:
+    # The server rendered page carries the hit count, no need for a headless render
+    content = await fetch.adecodo_scrape(filter_url, headless=False)
+    soup = HTMLParser(content)
+    next_data = soup.css_first('script[id="__NEXT_DATA__"]')
+    if not next_data:
+        return None, None
+    page_props = json.loads(next_data.text())["props"]["pageProps"]
+    return page_props.get("numberOfResults"), None
+
+
 def get_filter_urls(car_dict, mileage_plus_minus) -> list[str]:
     # Using llm to get use the the make, model and version filter
     print("Generating Filter url based on row dict")
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=get_prompt_from_make(car_dict),
-        config=types.GenerateContentConfig(
-            response_mime_type="application/json",
-            response_schema=Filter,
-            system_instruction="You are an Intelligent Html Parser Bot, that prioritze data intergrity.",
-        ),
-    )
-    car_filter: Filter = response.parsed
+    car_filter = get_car_filter("autoscout24", car_dict, get_prompt_from_make)
 
     filter_urls = []
     # Clean and calculate some of the filters
@@ -273,22 +270,10 @@ def get_filter_urls(car_dict, mileage_plus_minus) -> list[str]:
 def main(car_dict: dict, mileage_plus_minus: int):
     filter_urls = get_filter_urls(car_dict, mileage_plus_minus)
     filter_urls.reverse()
-    cars = []
-    for idx, filter_url in enumerate(filter_urls):
-        print(f"Filter url - {filter_url}")
-        # get the listing page
-        is_basic_filter = idx == len(filter_urls) - 1
-        cars = get_the_listing_html(
-            car_dict,
-            filter_url,
-            domain,
-            car_dict["id"],
-            extract_10_cars,
-            is_basic_filter=is_basic_filter,
-        )
-        if cars:
-            break
-    utils.parse_and_save(car_dict, cars)
+    cars = cascade.search_cars(
+        site, car_dict, filter_urls, domain, extract_10_cars, aprobe_count
+    )
+    utils.parse_and_save(car_dict, cars, "autoscout24")
 
 
 if __name__ == "__main__":
@@ -1,13 +1,12 @@
-from time import sleep
 from typing import Any
 from urllib.parse import ParseResult, urlencode, urlunparse
 
-import httpx
-
-from browser import client, get_the_listing_html, types
+import cascade
+from browser import afetch_listing, get_car_filter
 from model.model import Car, Filter
-from utilities import utils
+from utilities import fetch, taxonomy, utils
 
+site = "lacentrale"
 domain = "https://www.lacentrale.fr/"
 
 lacentrale_fuel_dict = {
@@ -109,36 +108,50 @@ def user_prompt(models, colors, versions, fuel_types, target_dict):
         """
 
 
-def get_prompt_from_make(input_dict: dict) -> str:
+def normalize_make(make: str) -> str:
+    if make == "VW":
+        print("MAKE ", make)
+        return "VOLKSWAGEN"
+    elif make == "DS AUTOMOBILES":
+        return "DS"
+    return make
+
+
+@taxonomy.cached_taxonomy("lacentrale")
+def get_taxonomy(make: str) -> dict | None:
     print("Sending requests to get the models and versions")
-    params["makesModelsCommercialNames"] = input_dict["make"]
-    print(params)
+    taxonomy_params = {**params, "makesModelsCommercialNames": make}
+    print(taxonomy_params)
     headers = utils.get_json_from_local("./uploads/Lacentrale_Headers.json")
-    response = httpx.get(
+    response = fetch.get(
         "https://recherche.lacentrale.fr/v5/aggregations",
-        params=params,
+        params=taxonomy_params,
         headers=headers,
     )
     print(f"Filter - {response.status_code}")
     json_data = response.json()
-    all_models = []
-    all_colors = []
+    if not json_data["total"]:
+        return None
+    # Get all the models based on the make
+    models = json_data["aggs"]["vehicle.makeModelCommercialName"][0]["agg"]
+    # get all colors available
+    colors = json_data["aggs"]["vehicle.externalColor"]
+    # get all version associated to the make
+    versions = json_data["aggs"]["vehicle.version"]
+    return {
+        "models": [model["key"] for model in models],
+        "colors": [color["key"] for color in colors],
+        "versions": [version["key"] for version in versions],
+    }
+
+
+def get_prompt_from_make(input_dict: dict) -> str:
+    make_taxonomy = get_taxonomy(input_dict["make"]) or {}
+    all_models = make_taxonomy.get("models", [])
+    all_colors = make_taxonomy.get("colors", [])
     all_versions = []
-    if json_data["total"]:
-        # Get all the models based on the make
-        models = response.json()["aggs"]["vehicle.makeModelCommercialName"][0]["agg"]
-        for model in models:
-            # for inner_model in model["agg"]:
-            all_models.append(model["key"])
-        # get all colors available
-        colors = response.json()["aggs"]["vehicle.externalColor"]
-        for color in colors:
-            all_colors.append(color["key"])
-        if input_dict.get("version"):
-            # get all version associated to the make
-            versions = response.json()["aggs"]["vehicle.version"]
-            for version in versions:
-                all_versions.append(version["key"])
+    if input_dict.get("version"):
+        all_versions = make_taxonomy.get("versions", [])
 
     return user_prompt(
         all_models, all_colors, all_versions, lacentrale_fuel_dict, input_dict
@@ -193,20 +206,16 @@ def get_filter_url(params: dict, car_dict: dict, car_filter: Filter) -> str:
     return filter_url
 
 
+async def aprobe_count(filter_url: str) -> tuple[int | None, Any]:
+    # The listing api is plain json, its total comes with the first page
+    json_data = await afetch_listing(filter_url, domain)
+    return json_data.get("total"), json_data
+
+
 def get_filter_urls(car_dict: dict, mileage_plus_minus: int = 10000):
     print("CAR - ", car_dict)
     print("Generating Filter url based on row dict")
-    prompt_to_use = get_prompt_from_make(car_dict)
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=prompt_to_use,
-        config=types.GenerateContentConfig(
-            response_mime_type="application/json",
-            response_schema=Filter,
-            system_instruction="You are an Intelligent Html Parser Bot, that prioritze data intergrity.",
-        ),
-    )
-    car_filter: Filter = response.parsed
+    car_filter = get_car_filter("lacentrale", car_dict, get_prompt_from_make)
     km_from = abs(round(car_filter.mileage - mileage_plus_minus))
     km_to = abs(round(car_filter.mileage + mileage_plus_minus))
     equipments = get_options(car_dict)
@@ -262,38 +271,15 @@ def get_filter_urls(car_dict: dict, mileage_plus_minus: int = 10000):
 
 @utils.runner
 def main(car_dict: dict, mileage_plus_minus) -> list[Car]:
-    make = car_dict["make"]
-    if make == "VW":
-        print("MAKE ", make)
-        make = "VOLKSWAGEN"
-    elif make == "DS AUTOMOBILES":
-        make = "DS"
-    car_dict["make"] = make
+    car_dict["make"] = normalize_make(car_dict["make"])
     try:
         filter_urls = get_filter_urls(car_dict, mileage_plus_minus)
     except Exception as e:
         print(e)
     filter_urls.reverse()
-    cars = []
-    for idx, filter_url in enumerate(filter_urls):
-        print(f"Filter url - {filter_url}")
-        # get the listing page
-        is_basic_filter = idx == len(filter_urls) - 1
-        cars = get_the_listing_html(
-            car_dict,
-            filter_url,
-            domain,
-            car_dict["id"],
-            extract_10_cars,
-            is_basic_filter=is_basic_filter,
-        )
-        print(f"Total cars - {len(cars)}")
-        if cars:
-            break
-        sleep_secs = 3
-        print(f"Sleeping for {sleep_secs} seconds")
-        sleep(sleep_secs)
-
+    cars = cascade.search_cars(
+        site, car_dict, filter_urls, domain, extract_10_cars, aprobe_count
+    )
     utils.parse_and_save(car_dict, cars, "lacentrale")
 
 
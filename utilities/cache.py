@@ -0,0 +1,185 @@
+import hashlib
+import json
+import time
+from fnmatch import fnmatch
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable
+
+import redis
+import redis.asyncio
+
+from config import config
+
+_redis_client: redis.Redis | None = None
+_async_redis_client: redis.asyncio.Redis | None = None
+
+
+def get_redis() -> redis.Redis:
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(
+            config.CACHE_REDIS_URL, decode_responses=True
+        )
+    return _redis_client
+
+
+def get_async_redis() -> redis.asyncio.Redis:
+    # Bound to the event loop of its first caller, the fetch loop
+    global _async_redis_client
+    if _async_redis_client is None:
+        _async_redis_client = redis.asyncio.Redis.from_url(
+            config.CACHE_REDIS_URL, decode_responses=True
+        )
+    return _async_redis_client
+
+
+def get_version(name: str) -> int:
+    # Counters bumped on writes, data cached under an older version is stale
+    try:
+        return int(get_redis().get(f"version:{name}") or 0)
+    except Exception as e:
+        print(f"Version error - {e}")
+        return 0
+
+
+def bump_version(name: str):
+    try:
+        get_redis().incr(f"version:{name}")
+    except Exception as e:
+        print(f"Version error - {e}")
+
+
+class RedisBackend:
+    def __init__(self, namespace: str):
+        self.prefix = f"cache:{namespace}:"
+
+    def get(self, key: str) -> str | None:
+        return get_redis().get(self.prefix + key)
+
+    def set(self, key: str, value: str, ttl: int | None):
+        get_redis().set(self.prefix + key, value, ex=ttl)
+
+    def delete(self, key: str):
+        get_redis().delete(self.prefix + key)
+
+    def keys(self, pattern: str = "*") -> list[str]:
+        return [
+            key[len(self.prefix) :]
+            for key in get_redis().scan_iter(match=self.prefix + pattern)
+        ]
+
+
+class DiskBackend:
+    def __init__(self, namespace: str):
+        self.folder = Path(config.CACHE_DIR) / namespace
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.folder / f"{hashlib.sha1(key.encode()).hexdigest()}.json"
+
+    def get(self, key: str) -> str | None:
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if entry["expires_at"] and entry["expires_at"] < time.time():
+            self.delete(key)
+            return None
+        return entry["value"]
+
+    def set(self, key: str, value: str, ttl: int | None):
+        entry = {
+            "key": key,
+            "value": value,
+            "expires_at": time.time() + ttl if ttl else None,
+        }
+        # Write then rename so readers never see a partial file
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        tmp_path.replace(path)
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def keys(self, pattern: str = "*") -> list[str]:
+        keys = []
+        for path in self.folder.glob("*.json"):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    keys.append(json.load(f)["key"])
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+        return [key for key in keys if fnmatch(key, pattern)]
+
+
+class Cache:
+    """
+    JSON cache stored in the Redis instance used by Celery or on disk,
+    depending on CACHE_BACKEND. Cache failures never break the caller.
+    """
+
+    def __init__(self, namespace: str, ttl: int | None = None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self._backend = None
+
+    @property
+    def backend(self) -> RedisBackend | DiskBackend:
+        if self._backend is None:
+            if config.CACHE_BACKEND == "disk":
+                self._backend = DiskBackend(self.namespace)
+            else:
+                self._backend = RedisBackend(self.namespace)
+        return self._backend
+
+    def get(self, key: str) -> Any | None:
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            print(f"Cache error - {e}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: Any, ttl: int | None = None):
+        try:
+            self.backend.set(key, json.dumps(value, default=str), ttl or self.ttl)
+        except Exception as e:
+            print(f"Cache error - {e}")
+
+    def delete(self, key: str):
+        try:
+            self.backend.delete(key)
+        except Exception as e:
+            print(f"Cache error - {e}")
+
+    def keys(self, pattern: str = "*") -> list[str]:
+        return self.backend.keys(pattern)
+
+    def clear(self, pattern: str = "*") -> int:
+        keys = self.keys(pattern)
+        for key in keys:
+            self.delete(key)
+        return len(keys)
+
+    def memoize(self, key_func: Callable[..., str]):
+        # Empty results are not cached so failed lookups are retried
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                key = key_func(*args, **kwargs)
+                value = self.get(key)
+                if value is not None:
+                    print(f"Cache hit - {self.namespace}:{key}")
+                    return value
+                value = func(*args, **kwargs)
+                if value:
+                    self.set(key, value)
+                return value
+
+            return wrapper
+
+        return decorator
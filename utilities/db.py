@@ -0,0 +1,288 @@
+import asyncio
+import queue
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from supabase import AsyncClient, Client, acreate_client, create_client
+from supabase.lib.client_options import AsyncClientOptions, SyncClientOptions
+
+from config import config
+
+# Conflict target of the upserts, the primary key of each table
+conflict_keys = {
+    "Vehicles": "id",
+    "comparisons": "id",
+}
+
+
+def create_session() -> Client:
+    return create_client(
+        supabase_key=config.SUPABASE_KEY,
+        supabase_url=config.SUPABASE_URL,
+        options=SyncClientOptions(
+            postgrest_client_timeout=config.SUPABASE_POSTGREST_TIMEOUT
+        ),
+    )
+
+
+class ClientPool:
+    """
+    Thread safe pool of Supabase clients, each client keeps its PostgREST
+    connections open between checkouts. Clients idle for longer than the
+    health check interval are checked before being handed out.
+    """
+
+    def __init__(self, size: int | None = None):
+        self.size = size or config.SUPABASE_POOL_SIZE
+        self.idle: queue.LifoQueue[tuple[Client, float]] = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _reserve(self) -> bool:
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return True
+            return False
+
+    def _discard(self):
+        with self.lock:
+            self.created -= 1
+
+    def health_check(self, client: Client) -> bool:
+        try:
+            client.table("Status").select("id").limit(1).execute()
+            return True
+        except Exception as e:
+            print(f"Supabase health check failed - {e}")
+            return False
+
+    def acquire(self, timeout: float | None = None) -> Client:
+        try:
+            client, last_used = self.idle.get_nowait()
+        except queue.Empty:
+            if self._reserve():
+                try:
+                    return create_session()
+                except Exception as e:
+                    self._discard()
+                    raise e
+            client, last_used = self.idle.get(
+                timeout=timeout or config.SUPABASE_POOL_TIMEOUT
+            )
+        if time.monotonic() - last_used > config.SUPABASE_HEALTHCHECK_INTERVAL:
+            if not self.health_check(client):
+                close_session(client)
+                try:
+                    client = create_session()
+                except Exception as e:
+                    # The closed client gave its slot back
+                    self._discard()
+                    raise e
+        return client
+
+    def release(self, client: Client):
+        self.idle.put((client, time.monotonic()))
+
+    @contextmanager
+    def session(self):
+        client = self.acquire()
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "created": self.created,
+            "idle": self.idle.qsize(),
+        }
+
+    def close(self):
+        while True:
+            try:
+                client, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            close_session(client)
+            self._discard()
+
+
+def close_session(client: Client):
+    try:
+        client.postgrest.session.close()
+    except Exception as e:
+        print(f"Supabase close error - {e}")
+
+
+pool: ClientPool | None = None
+_pool_lock = threading.Lock()
+
+
+def init_pool(size: int | None = None) -> ClientPool:
+    global pool
+    with _pool_lock:
+        if pool is None:
+            pool = ClientPool(size)
+            # Open one client up front so configuration errors show at startup
+            pool.release(pool.acquire())
+    return pool
+
+
+def get_pool() -> ClientPool:
+    return pool or init_pool()
+
+
+@contextmanager
+def session():
+    with get_pool().session() as client:
+        yield client
+
+
+def merge_rows(rows: list[dict], key: str) -> list[dict]:
+    # A batch can not upsert the same key twice, later values win
+    merged: dict = {}
+    for row in rows:
+        merged[row[key]] = {**merged.get(row[key], {}), **row}
+    return list(merged.values())
+
+
+def upsert(table: str, rows: dict | list[dict], on_conflict: str | None = None):
+    on_conflict = on_conflict or conflict_keys[table]
+    rows = merge_rows(rows if isinstance(rows, list) else [rows], on_conflict)
+    # PostgREST sends the columns of the whole batch and would overwrite the
+    # missing ones with null, so rows are grouped by their set of columns
+    groups: dict[tuple, list[dict]] = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    with session() as client:
+        for group in groups.values():
+            client.table(table).upsert(group, on_conflict=on_conflict).execute()
+
+
+def close_pool():
+    global pool
+    with _pool_lock:
+        if pool is not None:
+            pool.close()
+            pool = None
+
+
+async def acreate_session() -> AsyncClient:
+    return await acreate_client(
+        supabase_key=config.SUPABASE_KEY,
+        supabase_url=config.SUPABASE_URL,
+        options=AsyncClientOptions(
+            postgrest_client_timeout=config.SUPABASE_POSTGREST_TIMEOUT
+        ),
+    )
+
+
+class AsyncClientPool:
+    """
+    ClientPool for the api event loop, waiting for a client or a query never
+    holds a thread. Only used from the loop that created it, so it needs no
+    lock.
+    """
+
+    def __init__(self, size: int | None = None):
+        self.size = size or config.SUPABASE_ASYNC_POOL_SIZE
+        self.idle: asyncio.LifoQueue[tuple[AsyncClient, float]] = (
+            asyncio.LifoQueue()
+        )
+        self.created = 0
+
+    async def health_check(self, client: AsyncClient) -> bool:
+        try:
+            await client.table("Status").select("id").limit(1).execute()
+            return True
+        except Exception as e:
+            print(f"Supabase health check failed - {e}")
+            return False
+
+    async def acquire(self, timeout: float | None = None) -> AsyncClient:
+        try:
+            client, last_used = self.idle.get_nowait()
+        except asyncio.QueueEmpty:
+            if self.created < self.size:
+                self.created += 1
+                try:
+                    return await acreate_session()
+                except Exception as e:
+                    self.created -= 1
+                    raise e
+            client, last_used = await asyncio.wait_for(
+                self.idle.get(), timeout or config.SUPABASE_POOL_TIMEOUT
+            )
+        if time.monotonic() - last_used > config.SUPABASE_HEALTHCHECK_INTERVAL:
+            if not await self.health_check(client):
+                await aclose_session(client)
+                try:
+                    client = await acreate_session()
+                except Exception as e:
+                    # The closed client gave its slot back
+                    self.created -= 1
+                    raise e
+        return client
+
+    def release(self, client: AsyncClient):
+        self.idle.put_nowait((client, time.monotonic()))
+
+    @asynccontextmanager
+    async def session(self):
+        client = await self.acquire()
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "created": self.created,
+            "idle": self.idle.qsize(),
+        }
+
+    async def close(self):
+        while not self.idle.empty():
+            client, _ = self.idle.get_nowait()
+            await aclose_session(client)
+            self.created -= 1
+
+
+async def aclose_session(client: AsyncClient):
+    try:
+        await client.postgrest.session.aclose()
+    except Exception as e:
+        print(f"Supabase close error - {e}")
+
+
+async_pool: AsyncClientPool | None = None
+
+
+async def init_async_pool(size: int | None = None) -> AsyncClientPool:
+    global async_pool
+    if async_pool is None:
+        async_pool = AsyncClientPool(size)
+        async_pool.release(await async_pool.acquire())
+    return async_pool
+
+
+async def get_async_pool() -> AsyncClientPool:
+    return async_pool or await init_async_pool()
+
+
+@asynccontextmanager
+async def asession():
+    pool = await get_async_pool()
+    async with pool.session() as client:
+        yield client
+
+
+async def close_async_pool():
+    global async_pool
+    if async_pool is not None:
+        await async_pool.close()
+        async_pool = None
@@ -0,0 +1,150 @@
+import asyncio
+import threading
+from urllib.parse import urlparse
+
+import httpx
+
+from config import config
+from utilities import ratelimit
+
+DECODO_URL = "https://scraper-api.decodo.com/v2/scrape"
+DECODO_HEADERS = {
+    "accept": "application/json",
+    "content-type": "application/json",
+    "authorization": f"Basic {config.SMART_PROXY}",
+}
+
+# One event loop in a background thread owns every client, the scraper threads
+# hand it coroutines and wait for the result
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="fetch-loop", daemon=True
+            ).start()
+    return _loop
+
+
+def run(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result()
+
+
+def get_client(host: str) -> httpx.AsyncClient:
+    # Long lived client per upstream host, only used from the fetch loop
+    if host not in _clients:
+        _clients[host] = httpx.AsyncClient(
+            http2=config.HTTP2_ENABLED,
+            timeout=httpx.Timeout(config.HTTP_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=config.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=config.HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _clients[host]
+
+
+def with_cookies(headers: dict | None, cookies: dict | None) -> dict:
+    # Cookies are sent as a header so the shared clients keep no cookie state
+    headers = dict(headers or {})
+    if cookies:
+        headers["cookie"] = "; ".join([f"{k}={v}" for k, v in cookies.items()])
+    return headers
+
+
+async def arequest(
+    method: str,
+    url: str,
+    *,
+    headers: dict | None = None,
+    cookies: dict | None = None,
+    timeout: float | None = None,
+    **kwargs,
+) -> httpx.Response:
+    client = get_client(urlparse(url).netloc)
+    upstream = ratelimit.upstream_for(url)
+    for _ in range(config.RATE_LIMIT_RETRIES + 1):
+        await ratelimit.aacquire(upstream)
+        response = await client.request(
+            method,
+            url,
+            headers=with_cookies(headers, cookies),
+            timeout=timeout or config.HTTP_TIMEOUT,
+            **kwargs,
+        )
+        if response.is_success:
+            await ratelimit.areset(upstream)
+        if response.status_code != 429:
+            break
+        await ratelimit.apenalize(
+            upstream, ratelimit.parse_retry_after(response.headers.get("retry-after"))
+        )
+    return response
+
+
+async def aget(url: str, **kwargs) -> httpx.Response:
+    return await arequest("GET", url, **kwargs)
+
+
+async def apost(url: str, **kwargs) -> httpx.Response:
+    return await arequest("POST", url, **kwargs)
+
+
+async def adecodo_scrape(url: str, headless: bool = True) -> str:
+    json_data = {
+        "url": url,
+        "geo": "France",
+        "device_type": "mobile",
+    }
+    if headless:
+        json_data["headless"] = "html"
+    response = await apost(
+        DECODO_URL,
+        headers=DECODO_HEADERS,
+        json=json_data,
+        timeout=config.DECODO_TIMEOUT,
+    )
+    print(response)
+    if response.status_code != 200:
+        raise ValueError("Content is null")
+    content = None
+    results = response.json().get("results")
+    if results:
+        content = results[0]["content"]
+    if not content:
+        raise ValueError("Content is null")
+    return content
+
+
+def request(method: str, url: str, **kwargs) -> httpx.Response:
+    return run(arequest(method, url, **kwargs))
+
+
+def get(url: str, **kwargs) -> httpx.Response:
+    return run(aget(url, **kwargs))
+
+
+def post(url: str, **kwargs) -> httpx.Response:
+    return run(apost(url, **kwargs))
+
+
+def decodo_scrape(url: str, headless: bool = True) -> str:
+    return run(adecodo_scrape(url, headless))
+
+
+async def aclose():
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
+
+
+def close():
+    if _loop is not None:
+        run(aclose())
@@ -0,0 +1,82 @@
+import asyncio
+from typing import Any, Awaitable
+
+from fastapi import HTTPException
+
+from config import config
+from utilities import metrics
+
+
+class EndpointLimit:
+    """
+    Bounds the requests an endpoint serves at once and how long each may
+    take. A request that finds every slot taken for BACKPRESSURE_WAIT seconds
+    gets a 503 right away instead of queueing behind slow ones.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.concurrency = config.ENDPOINT_CONCURRENCY.get(
+            endpoint, config.DEFAULT_ENDPOINT_CONCURRENCY
+        )
+        self.timeout = config.ENDPOINT_TIMEOUTS.get(
+            endpoint, config.DEFAULT_ENDPOINT_TIMEOUT
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.active = 0
+
+    async def run(self, call: Awaitable[Any]) -> Any:
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), config.BACKPRESSURE_WAIT)
+        except asyncio.TimeoutError:
+            call.close()
+            await asyncio.to_thread(metrics.incr, "limits", f"{self.endpoint}:rejected")
+            raise HTTPException(
+                status_code=503,
+                detail=f"{self.endpoint} is busy, retry later",
+                headers={"Retry-After": str(max(int(config.BACKPRESSURE_WAIT), 1))},
+            )
+        self.active += 1
+        try:
+            return await asyncio.wait_for(call, self.timeout)
+        except asyncio.TimeoutError:
+            await asyncio.to_thread(metrics.incr, "limits", f"{self.endpoint}:timeouts")
+            raise HTTPException(
+                status_code=504,
+                detail=f"{self.endpoint} did not answer in {self.timeout}s",
+            )
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "timeout": self.timeout,
+            "active": self.active,
+        }
+
+
+limits: dict[str, EndpointLimit] = {}
+
+
+def get_limit(endpoint: str) -> EndpointLimit:
+    if endpoint not in limits:
+        limits[endpoint] = EndpointLimit(endpoint)
+    return limits[endpoint]
+
+
+async def limited(endpoint: str, call: Awaitable[Any]) -> Any:
+    return await get_limit(endpoint).run(call)
+
+
+def stats() -> dict[str, dict]:
+    counters = metrics.get("limits")
+    return {
+        endpoint: {
+            **limit.stats(),
+            "rejected": counters.get(f"{endpoint}:rejected", 0),
+            "timeouts": counters.get(f"{endpoint}:timeouts", 0),
+        }
+        for endpoint, limit in limits.items()
+    }
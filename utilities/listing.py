@@ -0,0 +1,245 @@
+import asyncio
+import threading
+import time
+from datetime import datetime
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+
+from cachetools import LRUCache
+
+from config import config
+from utilities.cache import Cache, get_version
+
+# Version bumped by the write buffer, see cache.get_version
+VERSION = "listing"
+count_cache = Cache("listing", ttl=config.COUNT_CACHE_TTL)
+
+# Sites whose matches are summarized on the Vehicles rows
+stats_sites = ["lacentrale", "autoscout24", "leboncoin"]
+# Fields added by compute, not columns of Vehicles
+computed_fields = [
+    "lowest_price",
+    "average_price",
+    "average_price_based_on_best_match",
+    "price_difference_with_avg_price",
+    "card_color",
+    "best_match_percentage",
+    "best_match_link",
+]
+# sort param -> (key, descending)
+sort_keys = {
+    "id": ("id", False),
+    "price_difference": ("price_difference_with_avg_price", False),
+    "-price_difference": ("price_difference_with_avg_price", True),
+}
+
+
+def stats_column(site: str) -> str:
+    # One column per site so the sites of a vehicle never overwrite each other
+    return f"{site}_stats"
+
+
+def site_of(domain: str) -> str:
+    # https://www.lacentrale.fr/ -> lacentrale
+    netloc = urlparse(domain).netloc or domain
+    parts = netloc.split(".")
+    return parts[-2] if len(parts) > 1 else netloc
+
+
+def to_matches(cars: list[dict]) -> list[list]:
+    # [matching_percentage, price, link] sorted from the best match
+    matches = [
+        [car.get("matching_percentage") or 0, car.get("price"), car.get("link")]
+        for car in cars
+    ]
+    matches.sort(key=lambda match: match[0], reverse=True)
+    return matches
+
+
+def summarize(cars: list[dict]) -> dict:
+    """
+    Compact form of the comparisons of one site, written with the vehicle so
+    listing pages need neither the comparisons nor a sort to show aggregates.
+    """
+    return {"matches": to_matches(cars), "updated_at": datetime.now().isoformat()}
+
+
+def vehicle_matches(vehicle: dict, sites: list[str] | None = None) -> list | None:
+    # None when the vehicle has no summary yet, see manage.py backfill-stats
+    stats = [vehicle.get(stats_column(site)) for site in sites or stats_sites]
+    stats = [s for s in stats if s]
+    if not stats:
+        return None
+    matches = [match for s in stats for match in s["matches"]]
+    matches.sort(key=lambda match: match[0], reverse=True)
+    return matches
+
+
+def compute(
+    price_with_tax: float,
+    matches: list[list],
+    percentage_limit: int = 95,
+    cut_off_price: int = 500,
+) -> dict:
+    prices = [price for _, price, _ in matches if price is not None] or [0]
+    # Matches are sorted, the best ones come first
+    best_prices = []
+    for matching_percentage, price, _ in matches:
+        if matching_percentage < percentage_limit:
+            break
+        if price:
+            best_prices.append(price)
+    avg_price = sum(best_prices) / len(best_prices) if best_prices else 0
+
+    if price_with_tax < avg_price:
+        card_color = "green"
+    elif abs(price_with_tax - avg_price) >= cut_off_price:
+        card_color = "red"
+    else:
+        card_color = "yellow"
+    return {
+        "lowest_price": min(prices),
+        "average_price": sum(prices) / len(prices),
+        "average_price_based_on_best_match": avg_price,
+        "price_difference_with_avg_price": avg_price - price_with_tax,
+        "card_color": card_color,
+        "best_match_percentage": matches[0][0] if matches else 0,
+        "best_match_link": matches[0][2] if matches else None,
+    }
+
+
+async def cached_count(
+    count_func: Callable[[], Awaitable[int]], fresh: bool = False
+) -> int:
+    """
+    Number of vehicles, counted again only once it was invalidated by a write
+    and is older than COUNT_REFRESH_INTERVAL, so a running scrape does not
+    recount on every flush. The Redis calls run in threads, off the api loop.
+    """
+    version = await asyncio.to_thread(get_version, VERSION)
+    entry = None if fresh else await asyncio.to_thread(count_cache.get, "vehicles")
+    if entry and (
+        (entry["version"] == version)
+        or (time.time() - entry["at"] < config.COUNT_REFRESH_INTERVAL)
+    ):
+        return entry["count"]
+    count = await count_func()
+    await asyncio.to_thread(
+        count_cache.set,
+        "vehicles",
+        {"count": count, "version": version, "at": time.time()},
+    )
+    return count
+
+
+def index_columns() -> list[str]:
+    # Columns of Vehicles loaded by the VehicleIndex
+    return ["id", "price_with_tax"] + [stats_column(site) for site in stats_sites]
+
+
+def name_pattern(value: str) -> str:
+    # Case insensitive equality for ilike, the wildcards of the value escaped
+    value = value.strip().replace("*", "")
+    for char in ["\\", "%", "_"]:
+        value = value.replace(char, f"\\{char}")
+    return value
+
+
+class VehicleIndex:
+    """
+    Light copy of every vehicle (price and match summaries) kept in process,
+    to filter and sort on the computed fields without joining comparisons.
+    Filters on columns run in PostgREST instead. Built on the first request
+    that needs it, then rebuilt once the listing version moved, at most every
+    LISTING_INDEX_REFRESH_INTERVAL seconds. Vehicles without summaries count
+    as having no match until backfill-stats ran.
+    """
+
+    def __init__(self):
+        self.rows: list[dict] = []
+        self.version: int | None = None
+        self.built_at = 0.0
+        # Rebuilds run on the api loop, filtering in worker threads
+        self.refresh_lock = asyncio.Lock()
+        self.lock = threading.Lock()
+        self.results = LRUCache(maxsize=config.LISTING_INDEX_RESULTS)
+
+    def is_fresh(self, version: int) -> bool:
+        age = time.time() - self.built_at
+        return (self.version is not None) and (
+            (self.version == version)
+            or (age < config.LISTING_INDEX_REFRESH_INTERVAL)
+        )
+
+    async def refresh(self, load_func: Callable[[], Awaitable[list[dict]]]):
+        version = await asyncio.to_thread(get_version, VERSION)
+        if self.is_fresh(version):
+            return
+        async with self.refresh_lock:
+            if self.is_fresh(version):
+                return
+            rows = await load_func()
+            with self.lock:
+                self.rows = rows
+                self.version, self.built_at = version, time.time()
+                self.results.clear()
+            print(f"Vehicle index - {len(rows)} vehicles, version {version}")
+
+    async def query(
+        self,
+        load_func: Callable[[], Awaitable[list[dict]]],
+        sites: list[str] | None = None,
+        percentage_limit: int = 95,
+        cut_off_price: int = 500,
+        card_color: str | None = None,
+        min_best_match: float | None = None,
+        sort: str = "id",
+    ) -> list[dict]:
+        # Matching vehicles in order, each as its id and computed fields
+        await self.refresh(load_func)
+        key = (
+            tuple(sites or []),
+            percentage_limit,
+            cut_off_price,
+            card_color,
+            min_best_match,
+            sort,
+        )
+        with self.lock:
+            rows, cached = self.rows, self.results.get(key)
+        if cached is not None:
+            return cached
+        # Computing every vehicle would hold the event loop
+        entries = await asyncio.to_thread(self.select, rows, key)
+        with self.lock:
+            self.results[key] = entries
+        return entries
+
+    def select(self, rows: list[dict], key: tuple) -> list[dict]:
+        (
+            sites,
+            percentage_limit,
+            cut_off_price,
+            card_color,
+            min_best_match,
+            sort,
+        ) = key
+        entries = []
+        for row in rows:
+            matches = vehicle_matches(row, list(sites)) or []
+            entry = compute(
+                row["price_with_tax"] or 0, matches, percentage_limit, cut_off_price
+            )
+            if card_color and (entry["card_color"] != card_color):
+                continue
+            if (min_best_match is not None) and (
+                entry["best_match_percentage"] < min_best_match
+            ):
+                continue
+            entries.append({"id": row["id"], **entry})
+        field, reverse = sort_keys[sort]
+        entries.sort(key=lambda entry: entry[field], reverse=reverse)
+        return entries
+
+
+vehicle_index = VehicleIndex()
@@ -0,0 +1,53 @@
+from collections import defaultdict
+
+from config import config
+from utilities.cache import get_redis
+
+# Counters are shared through Redis so every worker reports to the same place,
+# with a per process fallback when Redis is not used or unreachable
+_local_counters: dict[str, dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+
+def _use_redis() -> bool:
+    return config.CACHE_BACKEND != "disk"
+
+
+def incr(group: str, name: str, amount: float = 1):
+    if _use_redis():
+        try:
+            get_redis().hincrbyfloat(f"metrics:{group}", name, amount)
+            return
+        except Exception as e:
+            print(f"Metrics error - {e}")
+    _local_counters[group][name] += amount
+
+
+def get(group: str) -> dict[str, float]:
+    if _use_redis():
+        try:
+            counters = get_redis().hgetall(f"metrics:{group}")
+            return {name: float(value) for name, value in counters.items()}
+        except Exception as e:
+            print(f"Metrics error - {e}")
+    return dict(_local_counters[group])
+
+
+def reset(group: str):
+    if _use_redis():
+        try:
+            get_redis().delete(f"metrics:{group}")
+        except Exception as e:
+            print(f"Metrics error - {e}")
+    _local_counters.pop(group, None)
+
+
+def hit_ratio(group: str) -> dict[str, float]:
+    counters = get(group)
+    hits = counters.get("hits", 0)
+    misses = counters.get("misses", 0)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / total if total else 0,
+    }
@@ -0,0 +1,129 @@
+import json
+import time
+
+from config import config
+from utilities.cache import get_redis
+
+# Every event is also sent here so listeners do not need the run id
+CHANNEL = "progress"
+
+
+def progress_key(run_id: str) -> str:
+    return f"run:{run_id}:progress"
+
+
+def channel(run_id: str) -> str:
+    return f"{CHANNEL}:{run_id}"
+
+
+def publish(run_id: str, event: str, data: dict):
+    message = json.dumps({"event": event, "run_id": run_id, **data})
+    try:
+        redis = get_redis()
+        redis.publish(channel(run_id), message)
+        redis.publish(CHANNEL, message)
+    except Exception as e:
+        print(f"Progress error - {e}")
+
+
+def start(run_id: str, site_totals: dict[str, int], site_done: dict[str, int]):
+    """
+    Resets the counters of a run. `site_totals` counts every job of each
+    site, the ones a resumed run already did included, `site_done` those.
+    """
+    fields = {"started_at": time.time(), "status": "running"}
+    for site, total in site_totals.items():
+        fields[f"{site}:total"] = total
+        fields[f"{site}:finished"] = site_done.get(site, 0)
+        fields[f"{site}:baseline"] = site_done.get(site, 0)
+        fields[f"{site}:failed"] = 0
+    redis = get_redis()
+    redis.delete(progress_key(run_id))
+    redis.hset(progress_key(run_id), mapping=fields)
+    redis.expire(progress_key(run_id), config.RUN_STATE_TTL)
+    publish(run_id, "started", snapshot(run_id))
+
+
+def record(run_id: str, site: str, status: str) -> dict:
+    # Called once per finished job, failed ones included
+    try:
+        redis = get_redis()
+        redis.hincrby(progress_key(run_id), f"{site}:finished", 1)
+        if status == "failed":
+            redis.hincrby(progress_key(run_id), f"{site}:failed", 1)
+    except Exception as e:
+        print(f"Progress error - {e}")
+    data = snapshot(run_id)
+    publish(run_id, "progress", data)
+    return data
+
+
+def finish(run_id: str, status: str):
+    try:
+        get_redis().hset(progress_key(run_id), "status", status)
+    except Exception as e:
+        print(f"Progress error - {e}")
+    publish(run_id, "finished", snapshot(run_id))
+
+
+def eta(remaining: int, rate: float) -> float | None:
+    return remaining / rate if rate else None
+
+
+def snapshot(run_id: str) -> dict:
+    """
+    Completion of every site and of the run, with the throughput since the
+    run (or its resume) started and the ETA it gives.
+    """
+    try:
+        fields = get_redis().hgetall(progress_key(run_id))
+    except Exception as e:
+        print(f"Progress error - {e}")
+        fields = {}
+    if not fields:
+        return {"status": "unknown", "total": 0, "finished": 0, "sites": {}}
+    elapsed = max(time.time() - float(fields["started_at"]), 1e-6)
+    sites = {}
+    for name in fields:
+        if name.endswith(":total"):
+            site = name.split(":")[0]
+            total = int(fields[f"{site}:total"])
+            finished = int(fields[f"{site}:finished"])
+            rate = (finished - int(fields[f"{site}:baseline"])) / elapsed
+            sites[site] = {
+                "total": total,
+                "finished": finished,
+                "failed": int(fields[f"{site}:failed"]),
+                "completion": finished / total if total else 1,
+                "jobs_per_second": rate,
+                "eta_seconds": eta(total - finished, rate),
+            }
+    total = sum([s["total"] for s in sites.values()])
+    finished = sum([s["finished"] for s in sites.values()])
+    rate = sum([s["jobs_per_second"] for s in sites.values()])
+    return {
+        "status": fields.get("status"),
+        "total": total,
+        "finished": finished,
+        "completion": finished / total if total else 1,
+        "jobs_per_second": rate,
+        "eta_seconds": eta(total - finished, rate),
+        "elapsed_seconds": elapsed,
+        "sites": sites,
+    }
+
+
+def status_due(run_id: str) -> bool:
+    # At most one Status write per STATUS_WRITE_INTERVAL across all workers
+    try:
+        return bool(
+            get_redis().set(
+                f"run:{run_id}:status_written",
+                1,
+                nx=True,
+                px=int(config.STATUS_WRITE_INTERVAL * 1000),
+            )
+        )
+    except Exception as e:
+        print(f"Progress error - {e}")
+        return True
@@ -0,0 +1,263 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlparse
+
+from config import config
+from utilities.cache import get_async_redis, get_redis
+
+upstream_hosts = {
+    "mobile-app.lacentrale.fr": "lacentrale",
+    "recherche.lacentrale.fr": "lacentrale",
+    "scraper-api.decodo.com": "decodo",
+    "api.leboncoin.fr": "leboncoin",
+}
+
+# Returns the seconds to wait before a token is available, 0 when one was taken,
+# and whether a streak of 429s is on so a success knows it has one to reset.
+# Uses the Redis clock so every worker shares the same buckets.
+TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local strikes = redis.call('EXISTS', KEYS[3])
+
+local cooldown = tonumber(redis.call('GET', KEYS[2]) or '0')
+if cooldown > now then
+    return {tostring(cooldown - now), strikes}
+end
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return {tostring(wait), strikes}
+"""
+
+# Extends the cooldown to now + ARGV[1] seconds, never shortens a longer one.
+# The key expires with the cooldown it holds.
+COOLDOWN_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local cooldown = tonumber(redis.call('GET', KEYS[1]) or '0')
+cooldown = math.max(cooldown, now + tonumber(ARGV[1]))
+redis.call('SET', KEYS[1], tostring(cooldown), 'EX', math.ceil(cooldown - now) + 1)
+return tostring(cooldown)
+"""
+
+
+def upstream_for(url: str) -> str | None:
+    return upstream_hosts.get(urlparse(url).netloc)
+
+
+class LocalBucket:
+    # Per process fallback when Redis is not used or unreachable
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+        self.cooldown_until = 0.0
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            if self.cooldown_until > now:
+                return self.cooldown_until - now
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def cool_down(self, seconds: float):
+        with self.lock:
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    def __init__(self, upstream: str, rate: float, burst: float):
+        self.upstream = upstream
+        self.rate = rate
+        self.burst = burst
+        self.keys = [f"ratelimit:{upstream}:bucket", f"ratelimit:{upstream}:cooldown"]
+        self.strikes_key = f"ratelimit:{upstream}:strikes"
+        self.local = LocalBucket(rate, burst)
+        # Seen by the last take, a success only resets a streak that is on
+        self.has_strikes = False
+
+    def _use_redis(self) -> bool:
+        return config.CACHE_BACKEND != "disk"
+
+    def take(self) -> float:
+        if self._use_redis():
+            try:
+                wait, strikes = get_redis().eval(
+                    TOKEN_BUCKET_SCRIPT,
+                    3,
+                    *self.keys,
+                    self.strikes_key,
+                    self.rate,
+                    self.burst,
+                )
+                self.has_strikes = bool(strikes)
+                return float(wait)
+            except Exception as e:
+                print(f"Rate limit error - {e}")
+        return self.local.take()
+
+    async def atake(self) -> float:
+        if self._use_redis():
+            try:
+                wait, strikes = await get_async_redis().eval(
+                    TOKEN_BUCKET_SCRIPT,
+                    3,
+                    *self.keys,
+                    self.strikes_key,
+                    self.rate,
+                    self.burst,
+                )
+                self.has_strikes = bool(strikes)
+                return float(wait)
+            except Exception as e:
+                print(f"Rate limit error - {e}")
+        return self.local.take()
+
+    def acquire(self):
+        while (wait := self.take()) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        while (wait := await self.atake()) > 0:
+            await asyncio.sleep(wait)
+
+    def backoff(self, strikes: int, retry_after: float | None = None) -> float:
+        # Honour Retry-After, otherwise back off exponentially on repeated 429s
+        seconds = retry_after or min(
+            config.RATE_LIMIT_MAX_BACKOFF,
+            config.RATE_LIMIT_BACKOFF * 2 ** (strikes - 1),
+        )
+        print(f"Rate limited by {self.upstream}, cooling down {seconds} seconds")
+        self.local.cool_down(seconds)
+        return seconds
+
+    def penalize(self, retry_after: float | None = None) -> float:
+        if not self._use_redis():
+            return self.backoff(1, retry_after)
+        try:
+            strikes = get_redis().incr(self.strikes_key)
+            get_redis().expire(self.strikes_key, int(config.RATE_LIMIT_MAX_BACKOFF))
+        except Exception as e:
+            print(f"Rate limit error - {e}")
+            strikes = 1
+        self.has_strikes = True
+        seconds = self.backoff(strikes, retry_after)
+        try:
+            get_redis().eval(COOLDOWN_SCRIPT, 1, self.keys[1], seconds)
+        except Exception as e:
+            print(f"Rate limit error - {e}")
+        return seconds
+
+    async def apenalize(self, retry_after: float | None = None) -> float:
+        if not self._use_redis():
+            return self.backoff(1, retry_after)
+        redis = get_async_redis()
+        try:
+            strikes = await redis.incr(self.strikes_key)
+            await redis.expire(self.strikes_key, int(config.RATE_LIMIT_MAX_BACKOFF))
+        except Exception as e:
+            print(f"Rate limit error - {e}")
+            strikes = 1
+        self.has_strikes = True
+        seconds = self.backoff(strikes, retry_after)
+        try:
+            await redis.eval(COOLDOWN_SCRIPT, 1, self.keys[1], seconds)
+        except Exception as e:
+            print(f"Rate limit error - {e}")
+        return seconds
+
+    def reset(self):
+        # A success ends the streak of 429s, the next one starts from the base.
+        # Without a streak, as on most calls, Redis is left alone
+        if self._use_redis() and self.has_strikes:
+            self.has_strikes = False
+            try:
+                get_redis().delete(self.strikes_key)
+            except Exception as e:
+                print(f"Rate limit error - {e}")
+
+    async def areset(self):
+        if self._use_redis() and self.has_strikes:
+            self.has_strikes = False
+            try:
+                await get_async_redis().delete(self.strikes_key)
+            except Exception as e:
+                print(f"Rate limit error - {e}")
+
+
+_limiters: dict[str, RateLimiter] = {}
+
+
+def get_limiter(upstream: str) -> RateLimiter | None:
+    if upstream not in config.RATE_LIMITS:
+        return None
+    if upstream not in _limiters:
+        rate, burst = config.RATE_LIMITS[upstream]
+        _limiters[upstream] = RateLimiter(upstream, rate, burst)
+    return _limiters[upstream]
+
+
+def acquire(upstream: str | None):
+    limiter = get_limiter(upstream) if upstream else None
+    if limiter:
+        limiter.acquire()
+
+
+async def aacquire(upstream: str | None):
+    limiter = get_limiter(upstream) if upstream else None
+    if limiter:
+        await limiter.aacquire()
+
+
+def penalize(upstream: str | None, retry_after: float | None = None):
+    limiter = get_limiter(upstream) if upstream else None
+    if limiter:
+        limiter.penalize(retry_after)
+
+
+async def apenalize(upstream: str | None, retry_after: float | None = None):
+    limiter = get_limiter(upstream) if upstream else None
+    if limiter:
+        await limiter.apenalize(retry_after)
+
+
+def reset(upstream: str | None):
+    limiter = get_limiter(upstream) if upstream else None
+    if limiter:
+        limiter.reset()
+
+
+async def areset(upstream: str | None):
+    limiter = get_limiter(upstream) if upstream else None
+    if limiter:
+        await limiter.areset()
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    # Only the delay-seconds form is used by our upstreams
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
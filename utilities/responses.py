@@ -0,0 +1,132 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Awaitable, Callable
+
+from cachetools import TTLCache
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+from config import config
+from utilities import metrics
+from utilities.cache import Cache, get_version
+
+# Version bumped by every Status update
+STATUS_VERSION = "status"
+
+
+class ResponseCache:
+    """
+    Caches the JSON body of read endpoints in process, and in Redis when
+    RESPONSE_CACHE_REDIS is set, keyed on the endpoint, its normalized
+    parameters and the versions of the data it reads. A write bumps the
+    version, so entries never need to be deleted. Bodies carry an ETag and a
+    matching If-None-Match gets a 304.
+    """
+
+    def __init__(self, namespace: str = "responses"):
+        self.local = TTLCache(
+            maxsize=config.RESPONSE_CACHE_SIZE, ttl=config.RESPONSE_CACHE_TTL
+        )
+        self.lock = threading.Lock()
+        self.shared = (
+            Cache(namespace, ttl=config.RESPONSE_CACHE_TTL)
+            if config.RESPONSE_CACHE_REDIS
+            else None
+        )
+
+    def key(self, endpoint: str, params: dict, versions: list[str]) -> str:
+        params = json.dumps(jsonable_encoder(params), sort_keys=True)
+        version = ":".join([f"{name}{get_version(name)}" for name in versions])
+        digest = hashlib.sha1(params.encode()).hexdigest()
+        return f"{endpoint}:{version}:{digest}"
+
+    def get(self, key: str) -> dict | None:
+        with self.lock:
+            entry = self.local.get(key)
+        if (entry is None) and self.shared:
+            entry = self.shared.get(key)
+            if entry is not None:
+                with self.lock:
+                    self.local[key] = entry
+        return entry
+
+    def set(self, key: str, entry: dict):
+        with self.lock:
+            self.local[key] = entry
+        if self.shared:
+            self.shared.set(key, entry)
+
+    def lookup(
+        self, endpoint: str, params: dict, versions: list[str]
+    ) -> tuple[str, dict | None]:
+        key = self.key(endpoint, params, versions)
+        return key, self.get(key)
+
+    def record(self, endpoint: str, outcome: str, not_modified: bool, ms: float):
+        if not_modified:
+            metrics.incr("responses", f"{endpoint}:not_modified")
+        metrics.incr("responses", f"{endpoint}:{outcome}")
+        metrics.incr("responses", f"{endpoint}:{outcome}_ms", ms)
+
+    async def respond(
+        self,
+        request: Request,
+        endpoint: str,
+        params: dict,
+        versions: list[str],
+        build: Callable[[], Awaitable[Any]],
+    ) -> Response:
+        # The Redis calls run in threads so a hit never holds the event loop
+        start = time.perf_counter()
+        key, entry = await asyncio.to_thread(self.lookup, endpoint, params, versions)
+        outcome = "hits"
+        if entry is None:
+            outcome = "misses"
+            body = json.dumps(jsonable_encoder(await build()))
+            etag = f'"{hashlib.sha1(body.encode()).hexdigest()}"'
+            entry = {"body": body, "etag": etag}
+            await asyncio.to_thread(self.set, key, entry)
+
+        headers = {"ETag": entry["etag"], "Cache-Control": "no-cache"}
+        not_modified = request.headers.get("if-none-match") == entry["etag"]
+        if not_modified:
+            response = Response(status_code=304, headers=headers)
+        else:
+            response = Response(
+                content=entry["body"], media_type="application/json", headers=headers
+            )
+        await asyncio.to_thread(
+            self.record,
+            endpoint,
+            outcome,
+            not_modified,
+            (time.perf_counter() - start) * 1000,
+        )
+        return response
+
+
+def stats() -> dict[str, dict]:
+    # Hit ratio and mean latency of hits and misses per endpoint
+    counters = metrics.get("responses")
+    endpoints = {name.split(":")[0] for name in counters}
+    report = {}
+    for endpoint in sorted(endpoints):
+        hits = counters.get(f"{endpoint}:hits", 0)
+        misses = counters.get(f"{endpoint}:misses", 0)
+        report[endpoint] = {
+            "hits": hits,
+            "misses": misses,
+            "not_modified": counters.get(f"{endpoint}:not_modified", 0),
+            "hit_ratio": hits / (hits + misses) if hits + misses else 0,
+            "hit_ms": counters.get(f"{endpoint}:hits_ms", 0) / hits if hits else 0,
+            "miss_ms": (
+                counters.get(f"{endpoint}:misses_ms", 0) / misses if misses else 0
+            ),
+        }
+    return report
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,103 @@
+import json
+from datetime import datetime
+
+from config import config
+from utilities import utils
+from utilities.cache import get_redis
+
+LAST_RUN_KEY = "run:last"
+
+
+def run_key(run_id: str, name: str) -> str:
+    return f"run:{run_id}:{name}"
+
+
+def job_key(row_id, site: str) -> str:
+    return f"{utils.id_key(row_id)}:{site}"
+
+
+def begin(run_id: str, params: dict, resume: bool = False) -> tuple[str, dict]:
+    """
+    Registers a new run, or when resuming returns the last run with its own
+    params so it continues on the same rows and skips the jobs already done.
+    """
+    redis = get_redis()
+    last = get_last()
+    if resume and last:
+        run_id, params = last["run_id"], last["params"]
+        redis.delete(run_key(run_id, "stopped"))
+        print(f"Resuming run {run_id} - {len(done_jobs(run_id))} jobs done")
+    else:
+        redis.set(
+            run_key(run_id, "params"),
+            json.dumps({**params, "started_at": datetime.now().isoformat()}),
+            ex=config.RUN_STATE_TTL,
+        )
+        redis.set(LAST_RUN_KEY, run_id, ex=config.RUN_STATE_TTL)
+    return run_id, params
+
+
+def new_generation(run_id: str) -> int:
+    """
+    Starts a new dispatch of the run. Tasks queued by an earlier dispatch,
+    e.g. before a stop and resume, carry an older generation and are skipped.
+    """
+    redis = get_redis()
+    generation = redis.incr(run_key(run_id, "generation"))
+    redis.expire(run_key(run_id, "generation"), config.RUN_STATE_TTL)
+    return generation
+
+
+def is_current(run_id: str, generation: int | None) -> bool:
+    if generation is None:
+        return True
+    current = get_redis().get(run_key(run_id, "generation"))
+    return int(current or 0) == generation
+
+
+def link_task(task_id: str, run_id: str):
+    get_redis().set(f"run:task:{task_id}", run_id, ex=config.RUN_STATE_TTL)
+
+
+def run_for_task(task_id: str) -> str:
+    return get_redis().get(f"run:task:{task_id}") or task_id
+
+
+def get_last() -> dict | None:
+    run_id = get_redis().get(LAST_RUN_KEY)
+    params = get_redis().get(run_key(run_id, "params")) if run_id else None
+    if not params:
+        return None
+    params = json.loads(params)
+    params.pop("started_at", None)
+    return {"run_id": run_id, "params": params}
+
+
+def set_rows(run_id: str, row_ids: list):
+    # The rows are kept so a resumed dev run does not sample other rows
+    get_redis().set(
+        run_key(run_id, "rows"), json.dumps(row_ids), ex=config.RUN_STATE_TTL
+    )
+
+
+def get_rows(run_id: str) -> list | None:
+    rows = get_redis().get(run_key(run_id, "rows"))
+    return json.loads(rows) if rows else None
+
+
+def mark_done(run_id: str, row_id, site: str):
+    redis = get_redis()
+    redis.sadd(run_key(run_id, "done"), job_key(row_id, site))
+    redis.expire(run_key(run_id, "done"), config.RUN_STATE_TTL)
+
+
+def done_jobs(run_id: str) -> set[str]:
+    return get_redis().smembers(run_key(run_id, "done"))
+
+
+def stop(run_id: str):
+    get_redis().set(run_key(run_id, "stopped"), 1, ex=config.RUN_STATE_TTL)
+
+
+def is_stopped(run_id: str) -> bool:
+    return bool(get_redis().exists(run_key(run_id, "stopped")))
@@ -0,0 +1,73 @@
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from config import config
+
+
+class SiteScheduler:
+    """
+    Runs jobs on one thread pool per site, so each site keeps its own
+    concurrency limit, while a global semaphore caps the jobs running at once.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int | None = None,
+        site_limits: dict[str, int] | None = None,
+    ):
+        self.global_limit = threading.BoundedSemaphore(
+            max_concurrency or config.MAX_CONCURRENCY
+        )
+        self.site_limits = site_limits or config.SITE_CONCURRENCY
+        self.executors: dict[str, ThreadPoolExecutor] = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
+
+    def executor(self, site: str) -> ThreadPoolExecutor:
+        with self.lock:
+            if site not in self.executors:
+                self.executors[site] = ThreadPoolExecutor(
+                    max_workers=self.site_limits.get(
+                        site, config.DEFAULT_SITE_CONCURRENCY
+                    ),
+                    thread_name_prefix=site,
+                )
+            return self.executors[site]
+
+    def _run(self, func, *args, **kwargs):
+        with self.global_limit:
+            return func(*args, **kwargs)
+
+    def submit(self, site: str, func, *args, **kwargs) -> Future:
+        return self.executor(site).submit(self._run, func, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True):
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
+
+
+def pop_completed_rows(pending: dict[int, list[Future]], block: bool = True) -> int:
+    # Wait until at least one row has all its sites done, then drop those rows
+    while True:
+        done_rows = [
+            row_id
+            for row_id, futures in pending.items()
+            if all([future.done() for future in futures])
+        ]
+        running = [
+            future
+            for futures in pending.values()
+            for future in futures
+            if not future.done()
+        ]
+        if done_rows or (not block) or (not running):
+            break
+        wait(running, return_when=FIRST_COMPLETED)
+    for row_id in done_rows:
+        pending.pop(row_id)
+    return len(done_rows)
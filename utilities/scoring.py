@@ -0,0 +1,139 @@
+import json
+import re
+import unicodedata
+from dataclasses import dataclass
+
+from config import config
+
+# Same weights as the matching prompt in browser.py
+WEIGHTS = {
+    "make": 20,
+    "model": 20,
+    "version": 20,
+    "mileage": 40,
+}
+# Sites whose candidate names leave the make out
+MAKELESS_DOMAINS = ["https://www.lacentrale.fr/"]
+
+
+@dataclass
+class LocalScore:
+    low: float
+    high: float
+    reason: str
+
+    @property
+    def score(self) -> float:
+        return round((self.low + self.high) / 2, 2)
+
+    def is_match(self, accept: float | None = None) -> bool:
+        accept = config.LOCAL_MATCH_ACCEPT if accept is None else accept
+        return self.low >= accept
+
+    def is_mismatch(self, reject: float | None = None) -> bool:
+        reject = config.LOCAL_MATCH_REJECT if reject is None else reject
+        return self.high <= reject
+
+    def is_decided(
+        self, accept: float | None = None, reject: float | None = None
+    ) -> bool:
+        return self.is_match(accept) or self.is_mismatch(reject)
+
+
+def normalize(value) -> str:
+    if value is None:
+        return ""
+    value = unicodedata.normalize("NFKD", str(value))
+    value = "".join([c for c in value if not unicodedata.combining(c)])
+    value = re.sub(r"[^a-z0-9.]+", " ", value.lower())
+    return " ".join(value.split())
+
+
+def tokens(value) -> set[str]:
+    return set(normalize(value).split())
+
+
+def token_set_similarity(reference, candidate) -> float | None:
+    # Share of the reference tokens found in the candidate, None when unknown
+    reference_tokens = tokens(reference)
+    candidate_tokens = tokens(candidate)
+    if (not reference_tokens) or (not candidate_tokens):
+        return None
+    return len(reference_tokens & candidate_tokens) / len(reference_tokens)
+
+
+def to_mileage(value) -> float | None:
+    try:
+        mileage = float(value)
+    except (ValueError, TypeError):
+        return None
+    # Empty cells of the input sheet are filled with 0
+    return mileage if mileage > 0 else None
+
+
+def mileage_similarity(reference, candidate) -> float | None:
+    reference = to_mileage(reference)
+    candidate = to_mileage(candidate)
+    if (reference is None) or (candidate is None):
+        return None
+    distance = abs(reference - candidate)
+    return max(0.0, 1 - distance / config.LOCAL_MATCH_MILEAGE_SCALE)
+
+
+def weighted_bounds(
+    similarity: float | None, weight: int, exact: bool = False
+) -> tuple[float, float]:
+    # Unknown or partial similarities leave room for the LLM to decide
+    if similarity is None:
+        return 0.0, weight
+    if exact or (similarity in (0, 1)):
+        return similarity * weight, similarity * weight
+    return similarity * weight, weight
+
+
+def pre_score(car_dict: dict, car: dict) -> LocalScore:
+    candidate = f"{car.get('name') or ''} {car.get('car_metadata') or ''}"
+    make = token_set_similarity(car_dict.get("make"), candidate)
+    model = token_set_similarity(car_dict.get("model"), candidate)
+    version = token_set_similarity(car_dict.get("version"), candidate)
+    mileage = mileage_similarity(car_dict.get("mileage"), car.get("mileage"))
+
+    # Without the make in the name the make term is left to the LLM, unless
+    # the model matches and implies it
+    if car.get("domain") in MAKELESS_DOMAINS:
+        make = 1 if model == 1 else None
+
+    bounds = {
+        "make": weighted_bounds(make, WEIGHTS["make"]),
+        "model": weighted_bounds(model, WEIGHTS["model"]),
+        "version": weighted_bounds(version, WEIGHTS["version"]),
+        "mileage": weighted_bounds(mileage, WEIGHTS["mileage"], exact=True),
+    }
+    low = sum([b[0] for b in bounds.values()])
+    high = sum([b[1] for b in bounds.values()])
+    reason = "Local pre-score - " + ", ".join(
+        [
+            f"{key} {b[0]:g}/{WEIGHTS[key]}"
+            if b[0] == b[1]
+            else f"{key} {b[0]:g}-{b[1]:g}/{WEIGHTS[key]}"
+            for key, b in bounds.items()
+        ]
+    )
+    return LocalScore(low=low, high=high, reason=reason)
+
+
+def record_match(car_dict: dict, car: dict, match: tuple[float, str | None]):
+    # Append the LLM decision to the corpus used by benchmarks/local_scoring.py
+    if not config.MATCH_CORPUS_FILE:
+        return
+    line = {
+        "car_dict": {
+            key: car_dict.get(key) for key in ["make", "model", "version", "mileage"]
+        },
+        "car": {
+            key: car.get(key) for key in ["name", "car_metadata", "mileage", "domain"]
+        },
+        "matching_percentage": match[0],
+    }
+    with open(config.MATCH_CORPUS_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(line, default=str) + "\n")
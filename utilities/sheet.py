@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import load_workbook
+
+from utilities import utils
+
+# Bump when the stored records change so older caches are rebuilt
+CACHE_VERSION = 2
+# Rows per Parquet row group, a single record read decodes one group
+ROW_GROUP_SIZE = 1000
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stat(path: Path) -> dict:
+    # Changes whenever the upload is replaced, checked before hashing it again
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def temp_path(path: Path) -> Path:
+    # Unique per writer, an upload and a worker may convert at the same time
+    fd, name = tempfile.mkstemp(dir=path.parent, prefix=f"{path.name}.", suffix=".tmp")
+    os.close(fd)
+    return Path(name)
+
+
+def cache_paths(path: Path) -> tuple[Path, Path]:
+    path = Path(path)
+    return path.with_suffix(".parquet"), path.with_suffix(".meta.json")
+
+
+def cell_value(value):
+    # Same conversion as pd.read_excel, whole floats become ints
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def read_columns(path: Path, columns: list[str] | None = None) -> pd.DataFrame:
+    """
+    Stream the first sheet row by row and keep only `columns`, named by their
+    letters like after numeric_to_alphabetic_column_name.
+    """
+    columns = columns or utils.row_columns
+    indexes = [utils.alphabetic_to_numeric_column_name(c) for c in columns]
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook.worksheets[0]
+        data = {column: [] for column in columns}
+        for values in worksheet.iter_rows(max_col=max(indexes) + 1, values_only=True):
+            picked = [values[i] if i < len(values) else None for i in indexes]
+            if all([value is None for value in picked]):
+                continue
+            for column, value in zip(columns, picked):
+                data[column].append(cell_value(value))
+    finally:
+        workbook.close()
+    return pd.DataFrame(data).fillna(value=0)
+
+
+def validate(df: pd.DataFrame):
+    if df.empty:
+        raise ValueError("The sheet has no rows")
+    ids = df[utils.basic_columns["id"]]
+    if not (ids != 0).any():
+        raise ValueError("Column B holds no vehicle ids")
+    prices = pd.to_numeric(
+        df[utils.basic_columns["price_with_no_tax"]], errors="coerce"
+    )
+    if prices.isna().any():
+        rows = (prices[prices.isna()].index + 1).tolist()
+        raise ValueError(f"Column K holds prices that are not numbers, rows {rows}")
+
+
+def normalize(path: Path) -> list[dict]:
+    # Car dicts of every row, the same as get_row_dict builds them
+    df = read_columns(path)
+    validate(df)
+    return utils.get_row_dicts(df)
+
+
+def to_table(records: list[dict]) -> pa.Table:
+    # Parquet columns hold a single type, mixed columns are stored as JSON
+    fields = list(records[0]) if records else []
+    arrays = {}
+    json_fields = []
+    for field in fields:
+        values = [record[field] for record in records]
+        try:
+            arrays[field] = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays[field] = pa.array(
+                [json.dumps(value, default=str) for value in values]
+            )
+            json_fields.append(field)
+    table = pa.table(arrays)
+    return table.replace_schema_metadata({"json_fields": json.dumps(json_fields)})
+
+
+def to_records(table: pa.Table) -> list[dict]:
+    metadata = table.schema.metadata or {}
+    json_fields = json.loads(metadata.get(b"json_fields", b"[]"))
+    columns = []
+    for field in table.column_names:
+        values = table.column(field).to_pylist()
+        if field in json_fields:
+            values = [json.loads(value) for value in values]
+        columns.append(values)
+    return [dict(zip(table.column_names, values)) for values in zip(*columns)]
+
+
+def write_cache(
+    path: Path, records: list[dict], source_hash: str, stat: dict | None = None
+):
+    """
+    Store the records as Parquet next to the upload, with a meta file holding
+    the source hash and stat and the id -> row offset index. The meta file is
+    written last so a reader never pairs it with an older Parquet file.
+    """
+    parquet_path = cache_paths(path)[0]
+    tmp_path = temp_path(parquet_path)
+    try:
+        pq.write_table(to_table(records), tmp_path, row_group_size=ROW_GROUP_SIZE)
+        tmp_path.replace(parquet_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    index = {}
+    for offset, record in enumerate(records):
+        index.setdefault(utils.id_key(record["id"]), offset)
+    write_meta(
+        path,
+        {
+            "version": CACHE_VERSION,
+            "source_hash": source_hash,
+            "source_stat": stat or file_stat(path),
+            "rows": len(records),
+            "index": index,
+        },
+    )
+    print(f"Converted - {path} - {len(records)} rows")
+
+
+def write_meta(path: Path, meta: dict):
+    meta_path = cache_paths(path)[1]
+    tmp_path = temp_path(meta_path)
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        tmp_path.replace(meta_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def read_meta(path: Path) -> dict | None:
+    parquet_path, meta_path = cache_paths(path)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"Sheet cache miss - {e}")
+        return None
+    if (meta.get("version") != CACHE_VERSION) or (not parquet_path.exists()):
+        return None
+    return meta
+
+
+def is_current(path: Path, source_hash: str) -> bool:
+    if not Path(path).exists():
+        return False
+    meta = read_meta(path)
+    return bool(meta) and (meta["source_hash"] == source_hash)
+
+
+def convert(
+    path: Path, source_hash: str | None = None, stat: dict | None = None
+) -> dict:
+    path = Path(path)
+    stat = stat or file_stat(path)
+    write_cache(path, normalize(path), source_hash or file_hash(path), stat)
+    return read_meta(path)
+
+
+def load_meta(path: Path) -> dict:
+    # Converts again when the upload was replaced without going through the api,
+    # the sheet is only hashed again once its mtime or size changed
+    path = Path(path)
+    stat = file_stat(path)
+    meta = read_meta(path)
+    if meta and (meta.get("source_stat") == stat):
+        return meta
+    source_hash = file_hash(path)
+    if meta and (meta["source_hash"] == source_hash):
+        # Touched but the same content, the new stat spares the next hash
+        meta["source_stat"] = stat
+        write_meta(path, meta)
+        return meta
+    return convert(path, source_hash, stat)
+
+
+def load_records(path: Path) -> list[dict]:
+    load_meta(path)
+    return to_records(pq.read_table(cache_paths(path)[0]))
+
+
+def load_record(path: Path, row_id) -> dict | None:
+    # Seek to the row group holding the vehicle instead of reading the sheet
+    meta = load_meta(path)
+    offset = meta["index"].get(utils.id_key(row_id))
+    if offset is None:
+        return None
+    parquet_file = pq.ParquetFile(cache_paths(path)[0])
+    group = parquet_file.read_row_group(offset // ROW_GROUP_SIZE)
+    return to_records(group.slice(offset % ROW_GROUP_SIZE, 1))[0]
@@ -0,0 +1,25 @@
+from config import config
+from utilities.cache import Cache
+
+# Models, colors and versions available on each site for a make
+taxonomy_cache = Cache("taxonomy", ttl=config.TAXONOMY_TTL)
+
+
+def taxonomy_key(site: str, make: str) -> str:
+    return f"{site}:{str(make).strip().lower()}"
+
+
+def cached_taxonomy(site: str):
+    return taxonomy_cache.memoize(lambda make: taxonomy_key(site, make))
+
+
+def invalidate(site: str | None = None, make: str | None = None) -> int:
+    if site and make:
+        pattern = taxonomy_key(site, make)
+    elif site:
+        pattern = f"{site}:*"
+    elif make:
+        pattern = f"*:{str(make).strip().lower()}"
+    else:
+        pattern = "*"
+    return taxonomy_cache.clear(pattern)
@@ -3,15 +3,18 @@ import os
 import string
 import traceback
 from datetime import datetime
+from functools import wraps
 
+import numpy as np
 import pandas as pd
 from dateparser import parse
 from fastapi.encoders import jsonable_encoder
 from selectolax.parser import Node
-from supabase import Client, create_client
 
 from config import config
 from model.model import Car
+from utilities import db, listing
+from utilities.writer import write_buffer
 
 url = config.SUPABASE_URL
 supabase_key = config.SUPABASE_KEY
@@ -28,6 +31,48 @@ fuel_types = {
     11: "Bi-Fuel",
     0: "Andere",
 }
+# Sheet columns of the car_dict fields
+basic_columns = {
+    "id": "B",
+    "make": "D",
+    "model": "E",
+    "version": "KC",
+    "color": "OH",
+    "mileage": "J",
+    "fuel_type": "DF",
+    "price_with_no_tax": "K",
+}
+equipment_columns = {
+    "camera_360": "JY",
+    "attelage": "AI",
+    "bluetooth": "FS",
+    "aide_stationnement_avant": "GR",
+    "radar_de_recul": "GS",
+    "camera_de_recul": "GT",
+    "kit_mains_libres": "FX",
+    "limiteur_de_vitesse": "KX",
+    "affichage_tete_haute": "FW",
+    "gps": "AL",
+    "toit_panoramique": "GD",
+    "toit_ouvrant": "AM",
+    "sieges_chauffants": "CX",
+    "assistant_changement_voie": "IV",
+    "assistant_maintien_voie": "IQ",
+}
+flag_columns = {"cuir": "FA", "4x4": "AP"}
+date_column = "I"
+gearbox_column = "DG"
+# Every column read by get_row_dict
+row_columns = sorted(
+    {
+        *basic_columns.values(),
+        *equipment_columns.values(),
+        *flag_columns.values(),
+        date_column,
+        gearbox_column,
+    }
+)
+CAR_URL = "https://auto-brass.com/decouvrir-les-occasions?freier_text={}"
 
 
 def get_json_from_local(path: str) -> dict | None:
@@ -48,6 +93,13 @@ def get_text(node: Node | None):
     return value
 
 
+def id_key(row_id) -> str:
+    # Sheet ids can come back as floats (12345.0) while the table holds 12345
+    if isinstance(row_id, float) and row_id.is_integer():
+        row_id = int(row_id)
+    return str(row_id)
+
+
 def drop_duplicate_cars(lst):
     seen = set()
     new_lst = []
@@ -74,6 +126,13 @@ def numeric_to_alphabetic_column_name(
     return result
 
 
+def alphabetic_to_numeric_column_name(name: str) -> int:
+    n = 0
+    for char in name:
+        n = n * 26 + string.ascii_uppercase.index(char) + 1
+    return n - 1
+
+
 def map_equipment(row_raw_dict: dict, key: str) -> bool | None:
     try:
         return True if int(row_raw_dict.get(key, 0)) == 1 else False
@@ -115,48 +174,91 @@ def get_row_dict(df: pd.DataFrame, row_id: int):
         row["year_to"] = None
 
     # Equipment fields: Set to French equipment name if value is 1, else None
-    row["camera_360"] = map_equipment(row_raw_dict, "JY")
-    row["attelage"] = map_equipment(row_raw_dict, "AI")
-    row["bluetooth"] = map_equipment(row_raw_dict, "FS")
-    row["aide_stationnement_avant"] = map_equipment(
-        row_raw_dict,
-        "GR",
-    )
-    row["radar_de_recul"] = map_equipment(row_raw_dict, "GS")
-    row["camera_de_recul"] = map_equipment(row_raw_dict, "GT")
-    row["kit_mains_libres"] = map_equipment(row_raw_dict, "FX")
-    row["limiteur_de_vitesse"] = map_equipment(row_raw_dict, "KX")
-    row["affichage_tete_haute"] = map_equipment(row_raw_dict, "FW")
-    row["gps"] = map_equipment(row_raw_dict, "AL")
-    row["toit_panoramique"] = map_equipment(row_raw_dict, "GD")
-    row["toit_ouvrant"] = map_equipment(row_raw_dict, "AM")
-    row["sieges_chauffants"] = map_equipment(row_raw_dict, "CX")
-    row["assistant_changement_voie"] = map_equipment(row_raw_dict, "IV")
-    row["assistant_maintien_voie"] = map_equipment(row_raw_dict, "IQ")
-    cuir_value = row_raw_dict.get("FA")
-    row["cuir"] = True if cuir_value == 1 else False
-
-    four_by_four = row_raw_dict.get("AP")
-    row["4x4"] = True if four_by_four == 1 else False
-
-    row["car_url"] = (
-        f"https://auto-brass.com/decouvrir-les-occasions?freier_text={row_raw_dict.get('B')}"
-    )
+    for field, column in equipment_columns.items():
+        row[field] = map_equipment(row_raw_dict, column)
+    for field, column in flag_columns.items():
+        row[field] = True if row_raw_dict.get(column) == 1 else False
+
+    row["car_url"] = CAR_URL.format(row_raw_dict.get("B"))
 
     return row
 
 
+def map_equipment_column(df: pd.DataFrame, column: str) -> list[bool | None]:
+    # Same as map_equipment: 1 is True, other numbers False, text None
+    if column not in df:
+        return [False] * len(df)
+    values = np.trunc(pd.to_numeric(df[column], errors="coerce"))
+    return (values == 1).astype(object).where(values.notna(), None).tolist()
+
+
+def map_flag_column(df: pd.DataFrame, column: str) -> list[bool]:
+    if column not in df:
+        return [False] * len(df)
+    return (df[column] == 1).tolist()
+
+
+def parse_years(column: pd.Series) -> list[int | None]:
+    """
+    Years of the date column. ISO dates, which include the timestamps read
+    by pandas, are parsed in one pass and dateparser only sees the other
+    distinct values once.
+    """
+    texts = column.astype(str)
+    uniques = pd.Series(texts.unique())
+    is_iso = uniques.str.match(r"^\d{4}-\d{2}")
+    dates = pd.to_datetime(
+        uniques.where(is_iso), format="ISO8601", errors="coerce", utc=True
+    )
+    years = {}
+    for text, date in zip(uniques.tolist(), dates.tolist()):
+        if pd.isna(date):
+            date = parse(text)
+        years[text] = date.year if date else None
+    missing = [text for text, year in years.items() if year is None]
+    if missing:
+        print(f"Date Error - {len(missing)} unparsed values, e.g. {missing[:5]}")
+    return [years[text] for text in texts.tolist()]
+
+
+def get_row_dicts(df: pd.DataFrame) -> list[dict]:
+    """
+    Columnar version of get_row_dict, builds the car dicts of every row of the
+    renamed and filled sheet at once.
+    """
+    columns = {
+        field: df[column].tolist() for field, column in basic_columns.items()
+    }
+    prices = df[basic_columns["price_with_no_tax"]].astype(float)
+    columns["price_with_tax"] = (prices * 1.19).tolist()
+    if gearbox_column in df:
+        gears = np.trunc(pd.to_numeric(df[gearbox_column], errors="coerce"))
+        columns["boite_de_vitesse"] = [
+            int(gear) if (gear == gear) and gear else None for gear in gears.tolist()
+        ]
+    else:
+        columns["boite_de_vitesse"] = [None] * len(df)
+
+    years = parse_years(df[date_column])
+    columns["year_from"] = years
+    columns["year_to"] = years
+
+    for field, column in equipment_columns.items():
+        columns[field] = map_equipment_column(df, column)
+    for field, column in flag_columns.items():
+        columns[field] = map_flag_column(df, column)
+
+    ids = df["B"].tolist() if "B" in df else [None] * len(df)
+    columns["car_url"] = [CAR_URL.format(row_id) for row_id in ids]
+
+    fields = list(columns)
+    return [dict(zip(fields, values)) for values in zip(*columns.values())]
+
+
 def save_to_db(data: dict | list[dict], table: str):
     print(f"SAVING - {len(data)}")
     try:
-        client: Client = create_client(
-            supabase_key=supabase_key,
-            supabase_url=url,
-        )
-        try:
-            client.table(table).insert(data).execute()
-        except Exception as _:
-            client.table(table).update(data).eq("id", data["id"]).execute()
+        db.upsert(table, data)
         return True
     except Exception as e:
         print(f"Saving Error - {e}")
@@ -195,16 +297,23 @@ def parse_and_save(car_dict: dict, cars: list[Car], site: str):
     jsoned_cars = jsonable_encoder(cars)
     print("Encoding data")
     compared_car_dicts = drop_duplicate_cars(jsoned_cars)
+    # Aggregates of the listing page, kept up to date with the comparisons
+    car_to_save_dict[listing.stats_column(site)] = listing.summarize(
+        compared_car_dicts
+    )
     print(f"Total cars to save {len(compared_car_dicts)}")
-    save_to_db(car_to_save_dict, "Vehicles")
+    write_buffer.add("Vehicles", car_to_save_dict)
     if compared_car_dicts:
-        save_to_db(compared_car_dicts, "comparisons")
+        write_buffer.add("comparisons", compared_car_dicts)
 
 
 def runner(func):
+    # True once func completed, False when it raised, the error is logged
+    @wraps(func)
     def wrapper(*args, **kwargs):
         try:
             func(*args, **kwargs)
+            return True
         except Exception as e:
             log_path = config.ERROR_FILE
             if not os.path.exists(log_path):
@@ -218,5 +327,6 @@ def runner(func):
                 error_file.write("Traceback:\n")
                 error_file.write(traceback.format_exc())
                 error_file.write("-" * 50 + "\n")
+            return False
 
     return wrapper
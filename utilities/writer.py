@@ -0,0 +1,155 @@
+import atexit
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+from config import config
+from utilities import db, listing, metrics
+from utilities.cache import bump_version
+
+# Parents first so the comparisons never reference a missing vehicle
+table_order = ["Vehicles", "comparisons"]
+
+
+class WriteBuffer:
+    """
+    Collects rows from every scraper thread and upserts them in batches, when
+    WRITE_BATCH_SIZE rows are waiting or the oldest row is WRITE_MAX_AGE
+    seconds old. Upserts are idempotent so failed batches are simply retried.
+    """
+
+    def __init__(
+        self,
+        batch_size: int | None = None,
+        max_age: float | None = None,
+        retries: int | None = None,
+    ):
+        self.batch_size = batch_size or config.WRITE_BATCH_SIZE
+        self.max_age = max_age or config.WRITE_MAX_AGE
+        self.retries = retries or config.WRITE_RETRIES
+        self.rows: dict[str, list[dict]] = {}
+        # Callbacks with the batches they wait for, the rows being collected
+        # are batch `self.batch`, the ones being written `self.flushing`
+        self.callbacks: list[tuple[set[int], Callable]] = []
+        self.batch = 0
+        self.flushing: int | None = None
+        self.oldest: float | None = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.written: deque[tuple[float, int]] = deque()
+        self.thread: threading.Thread | None = None
+
+    def pending(self) -> int:
+        return sum([len(rows) for rows in self.rows.values()])
+
+    def add(self, table: str, rows: dict | list[dict]):
+        rows = rows if isinstance(rows, list) else [rows]
+        if not rows:
+            return
+        with self.lock:
+            self.rows.setdefault(table, []).extend(rows)
+            self.oldest = self.oldest or time.monotonic()
+            full = self.pending() >= self.batch_size
+        self.start()
+        if full:
+            self.flush()
+
+    def defer(self, callback: Callable):
+        # Runs once the rows added so far are written, e.g. run checkpoints
+        with self.lock:
+            # A flush in progress may still be writing the rows of the caller
+            batches = set()
+            if self.pending():
+                batches.add(self.batch)
+            if self.flushing is not None:
+                batches.add(self.flushing)
+            if batches:
+                self.callbacks.append((batches, callback))
+        if not batches:
+            callback()
+
+    def start(self):
+        with self.lock:
+            if (self.thread is None) or (not self.thread.is_alive()):
+                self.thread = threading.Thread(
+                    target=self._run, name="write-buffer", daemon=True
+                )
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.max_age / 2)
+            if self.oldest and (time.monotonic() - self.oldest >= self.max_age):
+                self.flush()
+
+    def flush(self) -> bool:
+        # False when a batch could not be written and its rows were dropped
+        with self.flush_lock:
+            with self.lock:
+                batch, self.rows, self.oldest = self.rows, {}, None
+                self.flushing = self.batch
+                self.batch += 1
+            tables = [t for t in table_order if t in batch]
+            tables += [t for t in batch if t not in table_order]
+            written = True
+            for table in tables:
+                for idx in range(0, len(batch[table]), self.batch_size):
+                    rows = batch[table][idx : idx + self.batch_size]
+                    written = self._write(table, rows) and written
+            # Callbacks of this batch run once it is written, dropped rows leave
+            # theirs out and the jobs are done again
+            ready = []
+            with self.lock:
+                waiting = []
+                for batches, callback in self.callbacks:
+                    if self.flushing not in batches:
+                        waiting.append((batches, callback))
+                    elif written:
+                        batches.discard(self.flushing)
+                        if batches:
+                            waiting.append((batches, callback))
+                        else:
+                            ready.append(callback)
+                self.callbacks = waiting
+                self.flushing = None
+            for callback in ready:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Write callback error - {e}")
+            return written
+
+    def _write(self, table: str, rows: list[dict]) -> bool:
+        for attempt in range(self.retries + 1):
+            try:
+                db.upsert(table, rows)
+                self.written.append((time.monotonic(), len(rows)))
+                metrics.incr("writes", f"{table}:rows", len(rows))
+                metrics.incr("writes", f"{table}:batches")
+                bump_version(listing.VERSION)
+                print(f"SAVED - {len(rows)} rows to {table}")
+                return True
+            except Exception as e:
+                print(f"Saving Error - {table} - {e}")
+                if attempt < self.retries:
+                    time.sleep(2**attempt)
+        metrics.incr("writes", f"{table}:failed_rows", len(rows))
+        return False
+
+    def rows_per_second(self, window: float = 60) -> float:
+        now = time.monotonic()
+        while self.written and (now - self.written[0][0] > window):
+            self.written.popleft()
+        return sum([n for _, n in self.written]) / window
+
+    def stats(self) -> dict:
+        return {
+            **metrics.get("writes"),
+            "pending": self.pending(),
+            "rows_per_second": self.rows_per_second(),
+        }
+
+
+write_buffer = WriteBuffer()
+atexit.register(write_buffer.flush)